@@ -0,0 +1,46 @@
+import os
+import sys
+import time
+import argparse
+import statistics
+import subprocess
+
+SRC_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src')
+
+# Dependencies main.py used to import before parsing its arguments, whatever the run.
+EAGER_DEPENDENCIES = ['pandas', 'requests', 'tqdm', 'bs4', 'openpyxl', 'PySimpleGUI', 'gsheets_uploader']
+
+
+def cold_start(command, repeat):
+    timings = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = subprocess.run(command, cwd=SRC_PATH, capture_output=True, text=True)
+        timings.append(time.perf_counter() - start)
+        if result.returncode != 0:
+            return None, result.stderr.strip().splitlines()[-1]
+    return statistics.median(timings), None
+
+
+def import_command(modules):
+    return [sys.executable, '-c', ';'.join(f'import {module}' for module in modules)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Measure the cold start of the command line and of the library.')
+    parser.add_argument('-r', '--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    available = [module for module in EAGER_DEPENDENCIES if cold_start(import_command([module]), 1)[0] is not None]
+    missing = sorted(set(EAGER_DEPENDENCIES) - set(available))
+    if missing:
+        print(f'Not installed, left out of the eager imports: {", ".join(missing)}')
+
+    scenarios = [('python', [sys.executable, '-c', 'pass']),
+                 ('eager imports', import_command(available)),
+                 ('import kajin', import_command(['kajin'])),
+                 ('main.py --help', [sys.executable, 'main.py', '--help'])]
+    print(f'{"command":>16} {"cold start (s)":>15}')
+    for name, command in scenarios:
+        elapsed, error = cold_start(command, args.repeat)
+        print(f'{name:>16} {elapsed:>15.3f}' if error is None else f'{name:>16} {"failed: " + error:>15}')
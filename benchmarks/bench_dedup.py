@@ -0,0 +1,60 @@
+import os
+import sys
+import logging
+import argparse
+import tempfile
+
+import logzero
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import api_utils
+from api_utils import authenticate, get_alerts, get_all_apparts
+from processing_utils import cleaner, features_engineering
+from dedup_utils import drop_duplicate_ids, duplicate_groups
+from storage_utils import LinksStore
+from metrics_utils import RunMetrics
+from pipeline import resolve_links
+from bench_end_to_end import start_fake_server
+
+
+def run_links(metrics, workdir, dedup, link_workers):
+    session, headers = authenticate('kajin@example.com', 'password', pool_size=link_workers)
+    df_alerts = get_alerts(session, headers)
+    df_apparts, _ = get_all_apparts(df_alerts, session, headers)
+    nb_found = len(df_apparts)
+    df_apparts = drop_duplicate_ids(df_apparts)
+    groups = duplicate_groups(df_apparts) if dedup else None
+    df_apparts = features_engineering(cleaner(df_apparts))
+    links_store = LinksStore(os.path.join(workdir, 'links.sqlite'))
+    metrics.attach(session)
+    with metrics.stage('get_all_links'):
+        df_apparts = resolve_links(session, df_apparts, groups, False, links_store, link_workers)
+    links_store.close()
+    assert df_apparts['group_link' if dedup else 'link'].notna().all()
+    return nb_found, len(df_apparts), len(df_apparts) if groups is None else groups.nunique()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the link resolution of every listing with one per group of duplicates.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--duplicates', type=float, default=0.2, help='Share of the flats also listed on another portal.')
+    parser.add_argument('--shared', type=float, default=0.1, help='Share of the ads also found by another alert.')
+    parser.add_argument('--latency', type=float, default=0.01, help='Mean latency of the fake API, in seconds.')
+    parser.add_argument('-w', '--link-workers', type=int, default=8)
+    args = parser.parse_args()
+    logzero.loglevel(logging.WARNING)
+
+    print(f'{"ads":>8} {"dedup":>6} {"found":>7} {"apparts":>8} {"flats":>9} {"link requests":>14} {"time (s)":>9}')
+    for nb_ads in args.sizes:
+        server, port = start_fake_server(nb_ads=nb_ads, latency=args.latency, source_page_size=16 * 1024,
+                                         duplicates=args.duplicates, shared=args.shared)
+        api_utils.API_ROOT = f'http://127.0.0.1:{port}'
+        for dedup in [False, True]:
+            metrics = RunMetrics(api_utils.API_ROOT, trace_memory=False)
+            with tempfile.TemporaryDirectory() as workdir:
+                nb_found, nb_apparts, nb_flats = run_links(metrics, workdir, dedup, args.link_workers)
+            stage = metrics.stages[-1]
+            print(f'{nb_ads:>8} {str(dedup):>6} {nb_found:>7} {nb_apparts:>8} {nb_flats:>9} {stage["requests"]:>14} '
+                  f'{stage["wall_time"]:>9.2f}')
+        server.terminate()
@@ -0,0 +1,75 @@
+import os
+import sys
+import json
+import logging
+import argparse
+import tempfile
+import multiprocessing
+
+import logzero
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+import api_utils
+from metrics_utils import RunMetrics
+from export_utils import EXPORT_FORMATS
+from pipeline import Workspace, run_stages
+from fake_jinka import serve
+
+
+def start_fake_server(**kwargs):
+    ready = multiprocessing.Queue()
+    server = multiprocessing.Process(target=serve, kwargs={'port': 0, 'ready': ready, **kwargs}, daemon=True)
+    server.start()
+    return server, ready.get(timeout=600)
+
+
+def run_pipeline(metrics, root, concurrency, alert_concurrency, link_workers, cache, formats, dedup):
+    # The real pipeline, run in a temporary workspace so that every size starts without any database.
+    workspace = Workspace(root)
+    workspace.makedirs()
+    run_stages(workspace, metrics, 'kajin@example.com', 'password', False, concurrency, alert_concurrency, link_workers,
+               max_retries=5, full=False, history_backend='sqlite', cache_size=100 if cache else 0, formats=formats,
+               dedup=dedup, keep_coords=False, report_options={}, upload=None)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Run the pipeline against a local fake Jinka API and report per stage metrics.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--latency', type=float, default=0.01, help='Mean latency of the fake API, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0.01, help='Share of link requests answered with a 503.')
+    parser.add_argument('--source-page-size', type=int, default=16 * 1024)
+    parser.add_argument('-c', '--concurrency', type=int, default=8)
+    parser.add_argument('--alert-concurrency', type=int, default=4)
+    parser.add_argument('-w', '--link-workers', type=int, default=8)
+    parser.add_argument('--cache', action='store_true', help='Enable the HTTP cache.')
+    parser.add_argument('--formats', nargs='+', choices=EXPORT_FORMATS, default=['csv'])
+    parser.add_argument('--no-dedup', action='store_true', help='Resolve the link of every listing.')
+    parser.add_argument('--trace-memory', action='store_true',
+                        help='Trace the peak memory allocated by every stage, which noticeably slows down the threaded stages.')
+    parser.add_argument('-o', '--output', help='Optional path of a JSON report.')
+    args = parser.parse_args()
+    logzero.loglevel(logging.WARNING)
+
+    report = {}
+    for nb_ads in args.sizes:
+        server, port = start_fake_server(nb_ads=nb_ads, latency=args.latency, error_rate=args.error_rate,
+                                         source_page_size=args.source_page_size)
+        api_utils.API_ROOT = f'http://127.0.0.1:{port}'
+        metrics = RunMetrics(api_utils.API_ROOT, trace_memory=args.trace_memory)
+        with tempfile.TemporaryDirectory() as workdir:
+            run_pipeline(metrics, workdir, args.concurrency, args.alert_concurrency, args.link_workers, args.cache, args.formats,
+                         not args.no_dedup)
+        server.terminate()
+        report[nb_ads] = metrics.report()
+
+        print(f'\n{nb_ads} ads, {report[nb_ads]["wall_time"]:.1f}s in total')
+        print(f'{"stage":<22} {"wall time (s)":>14} {"requests":>9} {"req/s":>8} {"max RSS (MB)":>13} {"traced peak (MB)":>17}')
+        for stage in report[nb_ads]['stages']:
+            requests_per_second = stage['requests'] / stage['wall_time'] if stage['wall_time'] else 0
+            print(f'{stage["stage"]:<22} {stage["wall_time"]:>14.2f} {stage["requests"]:>9} '
+                  f'{requests_per_second:>8.0f} {stage["max_rss_mb"] or 0:>13.1f} {stage["peak_memory_mb"] or 0:>17.1f}')
+
+    if args.output is not None:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
@@ -0,0 +1,127 @@
+import os
+import sys
+import time
+import argparse
+from datetime import datetime
+
+from bs4 import BeautifulSoup
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from expiration_utils import check_expiration
+
+FIXTURES_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'expiration')
+
+URL_FIXTURES = [
+    ('pap', 'https://www.pap.fr/annonce/locations-appartement-paris-75-g439', True),
+    ('pap', 'https://www.pap.fr/annonces/appartement-paris-11e-r412300123', False),
+    ('seloger', 'https://www.seloger.com/list.htm?projects=1/#expiree', True),
+    ('seloger', 'https://www.seloger.com/annonces/locations/appartement/paris-11eme-75/168123456.htm', False),
+    ('paruvendu', 'https://www.paruvendu.fr/immobilier/location/appartement/#showError404', True),
+    ('laforet', 'https://www.laforet.com/ville/location-appartement-paris-75011', True),
+    ('laforet', 'https://www.laforet.com/agence-immobiliere/paris11/location/paris-75011/appartement-123', False),
+    ('avendrealouer', 'https://www.avendrealouer.fr/location/paris-75/b-appartement/loc-1-2.html#expiree-annonce', True),
+    ('orpi', 'https://www.orpi.com/recherche/rent/louer-appartement/paris', True),
+    ('orpi', 'https://www.orpi.com/annonce-location-appartement-t2-paris-11-75011-b-e1abcd/', False),
+    ('fnaim', 'https://www.fnaim.fr/17-location-paris-75.htm', True),
+    ('fnaim', 'https://www.fnaim.fr/annonce-immobiliere/123456/17-location-appartement-2-pieces-paris-75011.htm', False),
+]
+
+
+class FixtureResponse:
+    # Mimics a streamed requests response and counts the bytes which are actually read.
+    def __init__(self, url, body=b'', encoding='utf-8'):
+        self.url = url
+        self.body = body
+        self.encoding = encoding
+        self.bytes_read = 0
+
+    @property
+    def text(self):
+        self.bytes_read = len(self.body)
+        return self.body.decode(self.encoding)
+
+    def iter_content(self, chunk_size=1):
+        for start in range(0, len(self.body), chunk_size):
+            chunk = self.body[start:start + chunk_size]
+            self.bytes_read += len(chunk)
+            yield chunk
+
+
+def legacy_expired_checker(response, row_tuple):
+    # Former implementation: the whole body is downloaded and parsed with html.parser.
+    source = row_tuple[1]['source']
+    true_expired_date = None
+    if source in ['logic-immo', 'century21', 'meilleursagents', 'locservice', 'lagenceblue']:
+        parsed_url = BeautifulSoup(response.text, 'html.parser')
+    elif source in ['pap', 'seloger', 'paruvendu', 'laforet', 'orpi', 'avendrealouer', 'fnaim', 'locatair']:
+        response.text
+        parsed_url = response.url.split('/')
+    else:
+        return true_expired_date
+    if source == 'logic-immo' and len(parsed_url.find_all(class_="expiredTxt")) != 0:
+        true_expired_date = datetime.now()
+    if source == 'pap' and parsed_url[3] == 'annonce':
+        true_expired_date = datetime.now()
+    if source == 'seloger' and parsed_url[-1] == '#expiree':
+        true_expired_date = datetime.now()
+    if source == 'paruvendu' and parsed_url[-1] == '#showError404':
+        true_expired_date = datetime.now()
+    if source == 'century21':
+        item = parsed_url.find_all(class_="content_msg")
+        item2 = parsed_url.find_all(class_="tw-font-semibold tw-text-lg")
+        if len(item) != 0 and item[0].strong.text == "Nous sommes désolés, la page à laquelle vous tentez d'accéder n'existe pas.":
+            true_expired_date = datetime.now()
+        if len(item2) != 0 and item2[0].text.strip() == "Cette annonce est désactivée, retrouvez ci-dessous une sélection de biens s'en rapprochant.":
+            true_expired_date = datetime.now()
+    if source == 'meilleursagents' and len(parsed_url.find_all(class_="error-page")) != 0:
+        true_expired_date = datetime.now()
+    if source == 'locservice' and len(parsed_url.find_all(class_="louerecemment")) != 0:
+        true_expired_date = datetime.now()
+    if source == 'laforet' and parsed_url[3] == 'ville':
+        true_expired_date = datetime.now()
+    if source == 'lagenceblue' and len(parsed_url.find_all(class_="label label-warning")) != 0:
+        true_expired_date = datetime.now()
+    if source == 'avendrealouer' and '#expiree' in parsed_url[-1]:
+        true_expired_date = datetime.now()
+    if source == 'orpi' and parsed_url[-2] == 'louer-appartement':
+        true_expired_date = datetime.now()
+    if source == 'fnaim' and len(parsed_url) > 3 and parsed_url[3] != 'annonce-immobiliere':
+        true_expired_date = datetime.now()
+    return true_expired_date
+
+
+def load_fixtures(url_body_size):
+    fixtures = []
+    for file_name in sorted(os.listdir(FIXTURES_PATH)):
+        source, state = file_name[:-len('.html')].split('_')
+        with open(os.path.join(FIXTURES_PATH, file_name), 'rb') as f:
+            fixtures.append((f'{source} ({state})', source, f'https://www.{source}.fr/annonce/1', f.read(), state != 'active'))
+    # The URL based sources are served with a body of a typical size, which the legacy checker downloads anyway.
+    for source, url, is_expired in URL_FIXTURES:
+        fixtures.append((f'{source} ({"expired" if is_expired else "active"})', source, url, b'<html>' + b' ' * url_body_size + b'</html>', is_expired))
+    return fixtures
+
+
+def run(checker, source, url, body, repeat):
+    row_tuple = ('1', {'source': source, 'expired_at': None})
+    start = time.perf_counter()
+    for _ in range(repeat):
+        response = FixtureResponse(url, body)
+        result = checker(response, row_tuple)
+    return (time.perf_counter() - start) / repeat, response.bytes_read, result is not None
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and the rule based expiration checks on fixture pages.')
+    parser.add_argument('-r', '--repeat', type=int, default=20)
+    parser.add_argument('--url-body-size', type=int, default=64 * 1024)
+    args = parser.parse_args()
+
+    print(f'{"fixture":<28} {"legacy (ms)":>11} {"legacy bytes":>13} {"rules (ms)":>11} {"rules bytes":>12} {"speedup":>8}')
+    for name, source, url, body, is_expired in load_fixtures(args.url_body_size):
+        legacy_time, legacy_bytes, legacy_expired = run(legacy_expired_checker, source, url, body, args.repeat)
+        rules_time, rules_bytes, rules_expired = run(check_expiration, source, url, body, args.repeat)
+        assert legacy_expired == rules_expired == is_expired, name
+        print(f'{name:<28} {legacy_time * 1000:>11.2f} {legacy_bytes:>13} {rules_time * 1000:>11.3f} {rules_bytes:>12} '
+              f'{legacy_time / rules_time:>7.0f}x')
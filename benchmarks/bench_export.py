@@ -0,0 +1,73 @@
+import os
+import re
+import sys
+import time
+import argparse
+import tempfile
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from processing_utils import cleaner, features_engineering
+from export_utils import write_export, sanitize_for_excel
+from bench_processing import synthetic_apparts
+
+
+def legacy_export_xlsx(df, path):
+    # Former implementation: a first full write, then a cell by cell clean-up and a second full write.
+    from openpyxl.utils.exceptions import IllegalCharacterError
+    try:
+        df.to_excel(path)
+    except IllegalCharacterError:
+        ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+        applymap = getattr(df, 'map', None) or df.applymap
+        applymap(lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x).to_excel(path)
+
+
+def exported_apparts(nb_ads):
+    df = features_engineering(cleaner(synthetic_apparts(nb_ads)))
+    # Scraped descriptions regularly contain control characters refused by openpyxl.
+    df.loc[df.index[::100], 'description'] = df.loc[df.index[::100], 'description'] + '\x0b\x1f'
+    return df
+
+
+def measure(function, df, path, trace_memory=True):
+    # tracemalloc slows down pure Python code a lot, so the timing and the peak memory come from separate runs.
+    start = time.perf_counter()
+    function(df, path)
+    elapsed = time.perf_counter() - start
+    if not trace_memory:
+        return elapsed, float('nan')
+    tracemalloc.start()
+    function(df, path)
+    peak_memory = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+    tracemalloc.stop()
+    return elapsed, peak_memory
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the former xlsx export with the streaming export and the columnar formats.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 50000])
+    parser.add_argument('--no-memory', action='store_true', help='Only measure the timings.')
+    args = parser.parse_args()
+
+    print(f'{"ads":>8} {"export":>14} {"time (s)":>9} {"peak memory (MB)":>17} {"size (MB)":>10}')
+    for nb_ads in args.sizes:
+        df = exported_apparts(nb_ads)
+        with tempfile.TemporaryDirectory() as workdir:
+            exports = [('legacy xlsx', 'legacy.xlsx', legacy_export_xlsx)]
+            exports += [(export_format, f'apparts.{export_format}', lambda df, path, export_format=export_format:
+                         write_export(df, path, export_format)) for export_format in ['csv', 'xlsx', 'parquet', 'feather']]
+            for name, file_name, function in exports:
+                path = os.path.join(workdir, file_name)
+                try:
+                    elapsed, peak_memory = measure(function, df, path, not args.no_memory)
+                except ImportError:
+                    print(f'{nb_ads:>8} {name:>14} {"skipped, pyarrow is not installed":>38}')
+                    continue
+                print(f'{nb_ads:>8} {name:>14} {elapsed:>9.2f} {peak_memory:>17.1f} {os.path.getsize(path) / 1024 / 1024:>10.1f}')
+            df_xlsx = pd.read_excel(os.path.join(workdir, 'apparts.xlsx'), index_col=0)
+            assert len(df_xlsx) == len(df) and list(df_xlsx.columns) == [str(column) for column in df.columns]
+            assert not sanitize_for_excel(df)['description'].str.contains('\x0b').any()
@@ -0,0 +1,48 @@
+import os
+import sys
+import time
+import argparse
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from api_utils import APPARTS_COLUMNS, AppartsAccumulator
+from synthetic import synthetic_pages
+
+
+def legacy_ingest(pages):
+    # Equivalent of the former `df = df.append(df_temp)` loop, which copied the whole frame for every page.
+    df_apparts = pd.DataFrame(columns=APPARTS_COLUMNS)
+    for _, page, ads in pages:
+        df_temp = pd.DataFrame.from_records(data=ads)
+        df_temp['page'] = page
+        df_apparts = pd.concat([df_apparts, df_temp])
+    return df_apparts
+
+
+def accumulator_ingest(pages):
+    accumulator = AppartsAccumulator()
+    for _, page, ads in pages:
+        accumulator.extend({**ad, 'page': page} for ad in ads)
+    return accumulator.to_df()
+
+
+def timeit(function, pages):
+    start = time.perf_counter()
+    df = function(pages)
+    return time.perf_counter() - start, len(df)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and the accumulator-based dashboard ingest.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f'{"ads":>8} {"pages":>6} {"legacy (s)":>11} {"accumulator (s)":>16} {"speedup":>8}')
+    for nb_ads in args.sizes:
+        pages = synthetic_pages(nb_ads)
+        legacy_time, legacy_rows = timeit(legacy_ingest, pages)
+        accumulator_time, accumulator_rows = timeit(accumulator_ingest, pages)
+        assert legacy_rows == accumulator_rows
+        print(f'{nb_ads:>8} {len(pages):>6} {legacy_time:>11.2f} {accumulator_time:>16.2f} {legacy_time / accumulator_time:>7.1f}x')
@@ -0,0 +1,68 @@
+import os
+import sys
+import json
+import time
+import argparse
+import tracemalloc
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from api_utils import records_to_df
+from processing_utils import cleaner, features_engineering
+from synthetic import synthetic_pages
+
+LEGACY_NUMERIC_COLUMNS = ['rent', 'rent_max', 'area', 'room', 'bedroom', 'floor', 'lat', 'lng', 'previous_rent', 'nb_spam',
+    'rentMinPerM2', 'page']
+
+
+def parse_pages(bodies):
+    # The ads are parsed from the dashboard responses, so the memory they use is only retained through the frame.
+    return [{**ad, 'page': page} for page, body in bodies for ad in json.loads(body)['ads']]
+
+
+def legacy_ingest(bodies):
+    # Former ingest: every field of the ads is kept, strings as objects and numbers as float64 once a value is missing.
+    df = pd.DataFrame.from_records(parse_pages(bodies))
+    for column in LEGACY_NUMERIC_COLUMNS:
+        df[column] = pd.to_numeric(df[column], errors='coerce')
+    return df
+
+
+def measure(function, data):
+    # Timed without tracemalloc, which slows down the allocations. Then the frame size as reported by pandas, the memory
+    # still held once the frame is built and the peak memory while building it.
+    start = time.perf_counter()
+    function(data)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    df = function(data)
+    retained, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return df, elapsed, df.memory_usage(deep=True).sum(), retained, peak
+
+
+def typed_ingest(bodies):
+    return records_to_df(parse_pages(bodies))
+
+
+def processed(df):
+    return features_engineering(cleaner(df.set_index('id')))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the memory used by the legacy and the typed ingest.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[10000, 100000])
+    args = parser.parse_args()
+
+    mb = 1024 * 1024
+    print(f'{"ads":>8} {"ingest":>7} {"stage":>10} {"time (s)":>9} {"frame (MB)":>11} {"retained (MB)":>14} {"peak (MB)":>10}')
+    for nb_ads in args.sizes:
+        bodies = [(page, json.dumps({'ads': ads})) for _, page, ads in synthetic_pages(nb_ads)]
+        for name, ingest in [('legacy', legacy_ingest), ('typed', typed_ingest)]:
+            df, elapsed, frame, retained, peak = measure(ingest, bodies)
+            print(f'{nb_ads:>8} {name:>7} {"ingest":>10} {elapsed:>9.2f} {frame / mb:>11.1f} {retained / mb:>14.1f} {peak / mb:>10.1f}')
+            df, elapsed, frame, retained, peak = measure(processed, df)
+            print(f'{nb_ads:>8} {name:>7} {"processed":>10} {elapsed:>9.2f} {frame / mb:>11.1f} {retained / mb:>14.1f} {peak / mb:>10.1f}')
+            del df
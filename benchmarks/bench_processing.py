@@ -0,0 +1,79 @@
+import os
+import sys
+import time
+import argparse
+import itertools
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from api_utils import records_to_df
+from processing_utils import cleaner, features_engineering
+from synthetic import synthetic_pages
+
+
+def legacy_metro_extractor(metro_ls):
+    stops_names = [x['name'] for x in metro_ls]
+    lines_names = [x['lines'] for x in metro_ls]
+    lines_names = set(itertools.chain.from_iterable(lines_names))
+    return [stops_names, lines_names]
+
+
+def legacy_cleaner(df, columns=['source_logo', 'source_label', 'search_type',
+ 'rent_max', 'bedroom', 'buy_type', 'new_real_estate', 'webview_link', 'source_description']):
+    # Former implementation: per-row lambdas and a merge on id.
+    df['features'] = df['features'].apply(lambda x: {} if pd.isna(x) else x)
+    # As under pandas 1.x, the normalized features are not indexed on id, only their id key is merged on.
+    df_extract = pd.json_normalize(df['features'].tolist())
+    df = df.merge(df_extract, how='left', on='id')
+    # Recent pandas versions return the merge key as a column instead of the index.
+    if 'id' in df.columns:
+        df = df.set_index('id')
+    metro_res = df['stops'].apply(lambda x: legacy_metro_extractor(x))
+    df[['metro_stations', 'metro_lines']] = pd.DataFrame(metro_res.tolist(), index=df.index)
+    columns_to_drop = columns + ['year', 'box', 'stops', 'features']
+    # Most of these fields are now left out at ingest.
+    df = df.drop(columns=columns_to_drop, errors='ignore')
+    return df
+
+
+def legacy_features_engineering(df):
+    df['price_m2'] = df['rent'] / df['area']
+    df['rent_evolution'] = df['previous_rent'] - df['rent']
+    df['geo_coords'] = df['lat'].astype('string') + ', ' + df['lng'].astype('string')
+    df = df.drop(columns=['previous_rent', 'lat', 'lng'])
+    return df
+
+
+def synthetic_apparts(nb_ads):
+    records = [{**ad, 'page': page} for _, page, ads in synthetic_pages(nb_ads) for ad in ads]
+    # A few apparts without features, as returned by the API.
+    for record in records[::50]:
+        record['features'] = None
+    return records_to_df(records).set_index('id')
+
+
+def timeit(function, df):
+    start = time.perf_counter()
+    result = function(df.copy())
+    return time.perf_counter() - start, result
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the legacy and the vectorized cleaner and features_engineering.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    args = parser.parse_args()
+
+    print(f'{"ads":>8} {"stage":>20} {"legacy (s)":>11} {"vectorized (s)":>15} {"speedup":>8}')
+    for nb_ads in args.sizes:
+        df = synthetic_apparts(nb_ads)
+        legacy_time, df_legacy = timeit(legacy_cleaner, df)
+        vectorized_time, df_vectorized = timeit(cleaner, df)
+        pd.testing.assert_frame_equal(df_legacy, df_vectorized)
+        print(f'{nb_ads:>8} {"cleaner":>20} {legacy_time:>11.3f} {vectorized_time:>15.3f} {legacy_time / vectorized_time:>7.1f}x')
+
+        legacy_time, df_legacy = timeit(legacy_features_engineering, df_legacy)
+        vectorized_time, df_vectorized = timeit(features_engineering, df_vectorized)
+        pd.testing.assert_frame_equal(df_legacy, df_vectorized)
+        print(f'{nb_ads:>8} {"features_engineering":>20} {legacy_time:>11.3f} {vectorized_time:>15.3f} {legacy_time / vectorized_time:>7.1f}x')
@@ -0,0 +1,59 @@
+import os
+import sys
+import time
+import argparse
+import tempfile
+import subprocess
+
+import pandas as pd
+
+from bench_end_to_end import start_fake_server
+
+MAIN_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src', 'main.py')
+
+
+def run_main(workdir, port, extra_args):
+    # main.py runs in its own process, so that its peak resident memory can be read once it exits.
+    command = [sys.executable, MAIN_PATH, '-e', 'kajin@example.com', '-p', 'password', '--formats', 'csv',
+               '--cache-size', '0'] + extra_args
+    csv_path = os.path.join(workdir, 'data', 'apparts.csv')
+    start = time.perf_counter()
+    process = subprocess.Popen(command, cwd=workdir, env={**os.environ, 'KAJIN_API_ROOT': f'http://127.0.0.1:{port}'},
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    first_output = None
+    while process.poll() is None:
+        if first_output is None and os.path.exists(csv_path) and os.path.getsize(csv_path) > 0:
+            first_output = time.perf_counter() - start
+        time.sleep(0.05)
+    elapsed = time.perf_counter() - start
+    if first_output is None and os.path.exists(csv_path):
+        first_output = elapsed
+    return first_output, elapsed
+
+
+def max_rss_mb():
+    # Peak resident memory of the largest child process which has exited so far, in MB (Linux reports it in KB).
+    import resource
+    return resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare the regular pipeline with the streaming mode, in time to first '
+                                                 'output and peak memory.')
+    parser.add_argument('-n', '--nb-ads', type=int, default=20000)
+    parser.add_argument('--chunk-size', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.005, help='Mean latency of the fake API, in seconds.')
+    parser.add_argument('--mode', choices=['regular', 'stream'],
+                        help='Run a single mode. The peak memory of the child processes only grows, so each mode is best '
+                             'measured from its own benchmark process.')
+    args = parser.parse_args()
+
+    server, port = start_fake_server(nb_ads=args.nb_ads, latency=args.latency, source_page_size=16 * 1024)
+    modes = {'regular': [], 'stream': ['--stream', '--chunk-size', str(args.chunk_size)]}
+    print(f'{"ads":>8} {"mode":>8} {"first output (s)":>17} {"total (s)":>10} {"peak RSS (MB)":>14} {"exported":>9}')
+    for mode in ([args.mode] if args.mode else modes):
+        with tempfile.TemporaryDirectory() as workdir:
+            first_output, elapsed = run_main(workdir, port, modes[mode])
+            nb_exported = len(pd.read_csv(os.path.join(workdir, 'data', 'apparts.csv'), sep=';', usecols=['id']))
+        print(f'{args.nb_ads:>8} {mode:>8} {first_output:>17.1f} {elapsed:>10.1f} {max_rss_mb():>14.0f} {nb_exported:>9}')
+    server.terminate()
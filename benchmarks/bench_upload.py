@@ -0,0 +1,82 @@
+import os
+import sys
+import time
+import json
+import random
+import argparse
+import tempfile
+import subprocess
+
+import pandas as pd
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from processing_utils import cleaner, features_engineering
+from sheets_utils import sync_table, sheet_rows, row_hash
+from bench_processing import synthetic_apparts
+from fake_sheets import FakeSheetsUploader
+
+
+def next_run(df, rng, churn):
+    # Between two runs, some apparts change their rent, some expire and some new ones are found.
+    nb_changes = max(1, int(len(df) * churn))
+    df = df.copy()
+    changed = rng.sample(list(df.index), nb_changes)
+    df.loc[changed, 'rent'] = df.loc[changed, 'rent'] - 50
+    df = df.drop(rng.sample(list(df.index.difference(changed)), nb_changes))
+    df_new = df.iloc[:nb_changes].copy()
+    df_new.index = pd.RangeIndex(df.index.max() + 1, df.index.max() + 1 + nb_changes, name=df.index.name)
+    return pd.concat([df_new, df])
+
+
+def row_hashes(nb_ads):
+    _, rows = sheet_rows(features_engineering(cleaner(synthetic_apparts(nb_ads))))
+    return {appart_id: row_hash(values) for appart_id, values in rows.items()}
+
+
+def check_hashes_across_processes(nb_ads, hash_seeds=('1', '3')):
+    # The snapshot is written by one run and read by the next one, so the row hashes must not depend on the hash seed
+    # of the process, which orders the sets of strings.
+    hashes = []
+    for hash_seed in hash_seeds:
+        output = subprocess.run([sys.executable, os.path.abspath(__file__), '--row-hashes', str(nb_ads)], check=True,
+                                capture_output=True, text=True, env={**os.environ, 'PYTHONHASHSEED': hash_seed}).stdout
+        hashes.append(json.loads(output))
+    nb_different = sum(hashes[0][appart_id] != hashes[1][appart_id] for appart_id in hashes[0])
+    assert nb_different == 0, f'{nb_different} / {nb_ads} row hashes depend on the hash seed.'
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compare full pushes of the apparts worksheet with diff based uploads.')
+    parser.add_argument('-n', '--sizes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--churn', type=float, default=0.01, help='Share of the apparts updated, deleted and inserted per run.')
+    parser.add_argument('--row-hashes', type=int, help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.row_hashes is not None:
+        print(json.dumps(row_hashes(args.row_hashes)))
+        sys.exit()
+    check_hashes_across_processes(min(args.sizes))
+
+    print(f'{"ads":>8} {"upload":>6} {"calls":>6} {"cells sent":>11} {"time (s)":>9}')
+    for nb_ads in args.sizes:
+        rng = random.Random(0)
+        df = features_engineering(cleaner(synthetic_apparts(nb_ads)))
+        full_uploader, diff_uploader = FakeSheetsUploader(), FakeSheetsUploader()
+        full_time, diff_time = 0, 0
+        with tempfile.TemporaryDirectory() as workdir:
+            snapshot_path = os.path.join(workdir, 'sheets_snapshot.json')
+            sync_table(diff_uploader, df, 'spreadsheet', 'apparts', snapshot_path)
+            full_uploader.push_table(df, 'spreadsheet', 'apparts')
+            first_cells = diff_uploader.cells_sent
+            for _ in range(args.runs):
+                df = next_run(df, rng, args.churn)
+                start = time.perf_counter()
+                full_uploader.push_table(df, 'spreadsheet', 'apparts')
+                full_time += time.perf_counter() - start
+                start = time.perf_counter()
+                sync_table(diff_uploader, df, 'spreadsheet', 'apparts', snapshot_path)
+                diff_time += time.perf_counter() - start
+                assert diff_uploader.table('apparts') == full_uploader.table('apparts') == sheet_rows(df)
+        print(f'{nb_ads:>8} {"full":>6} {sum(full_uploader.calls.values()) - 1:>6} {full_uploader.cells_sent - first_cells:>11} {full_time:>9.2f}')
+        print(f'{nb_ads:>8} {"diff":>6} {sum(diff_uploader.calls.values()) - 1:>6} {diff_uploader.cells_sent - first_cells:>11} {diff_time:>9.2f}')
@@ -0,0 +1,233 @@
+import re
+import sys
+import json
+import time
+import random
+import base64
+import argparse
+from datetime import datetime, timezone
+from urllib.parse import urlparse, parse_qs
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+from synthetic import SOURCES, synthetic_ad
+
+DASHBOARD_RE = re.compile(r'^/apiv2/alert/([^/]+)/dashboard$')
+ABUSES_RE = re.compile(r'^/apiv2/alert/([^/]+)/abuses$')
+SOURCE_RE = re.compile(r'^/sources/([^/]+)/([^/]+)$')
+
+
+class FakeJinka:
+    # Synthetic account: nb_ads ads spread over nb_alerts alerts, served ads_per_page at a time.
+    def __init__(self, nb_ads=1000, nb_alerts=4, ads_per_page=30, latency=0, error_rate=0, dashboard_error_rate=0,
+                 source_page_size=64 * 1024, token_lifetime=0, churn=0, duplicates=0, shared=0, seed=0):
+        self.ads_per_page = ads_per_page
+        self.token_lifetime = token_lifetime
+        self.churn = churn
+        self.nb_ads = nb_ads
+        self.latency = latency
+        self.error_rate = error_rate
+        self.dashboard_error_rate = dashboard_error_rate
+        self.random = random.Random(seed)
+        rng = random.Random(seed)
+        self.alerts = {f'alert{idx}': [] for idx in range(nb_alerts)}
+        self.ads = {}
+        for ad_id in range(nb_ads):
+            alert_id = f'alert{ad_id % nb_alerts}'
+            ad = synthetic_ad(ad_id, alert_id, rng)
+            self.alerts[alert_id].append(ad)
+            self.ads[str(ad_id)] = ad
+        self.add_duplicates(duplicates, shared, random.Random(seed + 1))
+        self.source_page = ('<html><body>' + '<div class="card">Appartement</div>' * (source_page_size // 34) + '</body></html>').encode()
+        self.abuses = []
+
+    def add_duplicates(self, duplicates, shared, rng):
+        # Relistings of a share of the flats on another portal under a new id, and a share of the ads
+        # also found by another alert under the same id.
+        ads = list(self.ads.values())
+        alert_ids = list(self.alerts)
+        for ad in rng.sample(ads, int(len(ads) * duplicates)):
+            relisting = {**ad, 'id': self.nb_ads, 'source': rng.choice([source for source in SOURCES if source != ad['source']])}
+            self.alerts[rng.choice(alert_ids)].append(relisting)
+            self.ads[str(self.nb_ads)] = relisting
+            self.nb_ads += 1
+        if len(alert_ids) > 1:
+            for ad in rng.sample(ads, int(len(ads) * shared)):
+                other_alert_id = rng.choice([alert_id for alert_id in alert_ids if alert_id != ad['alert_id']])
+                self.alerts[other_alert_id].append({**ad, 'alert_id': other_alert_id})
+
+    def nb_pages(self, alert_id):
+        return max(1, -(-len(self.alerts[alert_id]) // self.ads_per_page))
+
+    def dashboard(self, alert_id, page):
+        ads = self.alerts[alert_id]
+        nb_ads = len(ads)
+        return {
+            'ads': ads[(page - 1) * self.ads_per_page:page * self.ads_per_page],
+            'pagination': {'nbPages': self.nb_pages(alert_id), 'page': page,
+                           'totals': {'all': nb_ads, 'read': 0, 'unread': nb_ads, 'favorite': 0, 'contact': 0, 'deleted': 0}},
+        }
+
+    def access_token(self):
+        # Unsigned JWT, only its expiration matters to the client.
+        payload = {'sub': 'kajin', 'exp': int(time.time() + self.token_lifetime) if self.token_lifetime else None}
+        encode = lambda data: base64.urlsafe_b64encode(json.dumps(data).encode()).rstrip(b'=').decode()
+        return f'{encode({"alg": "none", "typ": "JWT"})}.{encode(payload)}.'
+
+    def is_authorized(self, authorization):
+        if not self.token_lifetime:
+            return True
+        try:
+            payload = authorization.split(' ')[1].split('.')[1]
+            exp = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))['exp']
+        except (AttributeError, IndexError, KeyError, ValueError):
+            return False
+        return time.time() < exp
+
+    def new_cycle(self):
+        # Every listing of the alerts simulates some activity: new ads on top of each alert,
+        # plus rent changes and expirations among the ads of the first page.
+        send_date = datetime.now(timezone.utc).isoformat(timespec='milliseconds').replace('+00:00', 'Z')
+        for alert_id, ads in self.alerts.items():
+            for _ in range(self.churn):
+                ad = synthetic_ad(self.nb_ads, alert_id, self.random)
+                ad['created_at'] = ad['sendDate'] = send_date
+                ad['expired_at'] = None
+                ads.insert(0, ad)
+                self.ads[str(self.nb_ads)] = ad
+                self.nb_ads += 1
+            first_page = [ad for ad in ads[self.churn:self.ads_per_page] if ad['expired_at'] is None]
+            for ad in self.random.sample(first_page, min(2 * self.churn, len(first_page)))[:self.churn]:
+                ad['previous_rent'], ad['rent'] = ad['rent'], ad['rent'] - self.random.randint(10, 100)
+            for ad in self.random.sample(first_page, min(self.churn, len(first_page))):
+                ad['expired_at'] = send_date
+
+    def alert_list(self):
+        return [{'id': alert_id, 'name': f'Alert {alert_id}', 'user_name': 'kajin', 'estimated_ads_per_day': len(ads) // 30}
+                for alert_id, ads in self.alerts.items()]
+
+    def wait(self):
+        if self.latency:
+            time.sleep(self.random.expovariate(1 / self.latency))
+
+    def fails(self, error_rate):
+        return (error_rate > 0) and (self.random.random() < error_rate)
+
+
+def make_handler(fake):
+
+    class FakeJinkaHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            pass
+
+        def send_body(self, status, body, content_type='application/json', headers={}):
+            if not isinstance(body, bytes):
+                body = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header('Content-Type', content_type)
+            self.send_header('Content-Length', str(len(body)))
+            for key, value in headers.items():
+                self.send_header(key, value)
+            self.end_headers()
+            self.wfile.write(body)
+
+        def send_json(self, data):
+            body = json.dumps(data).encode()
+            etag = f'W/"{len(body):x}-{hash(body) & 0xffffffff:x}"'
+            if self.headers.get('If-None-Match') == etag:
+                self.send_response(304)
+                self.send_header('ETag', etag)
+                self.send_header('Content-Length', '0')
+                self.end_headers()
+                return
+            self.send_body(200, body, headers={'ETag': etag})
+
+        def send_error_status(self):
+            self.send_body(503, {'error': 'unavailable'}, headers={'Retry-After': '0'})
+
+        def do_POST(self):
+            url = urlparse(self.path)
+            self.rfile.read(int(self.headers.get('Content-Length', 0)))
+            fake.wait()
+            if url.path == '/apiv2/user/auth':
+                self.send_body(200, {'access_token': fake.access_token()})
+            elif ABUSES_RE.match(url.path):
+                if not fake.is_authorized(self.headers.get('Authorization')):
+                    return self.send_body(401, {'error': 'unauthorized'})
+                if fake.fails(fake.error_rate):
+                    return self.send_error_status()
+                fake.abuses.append(ABUSES_RE.match(url.path).group(1))
+                self.send_body(200, {})
+            else:
+                self.send_body(404, {'error': 'not found'})
+
+        def do_GET(self):
+            url = urlparse(self.path)
+            query = parse_qs(url.query)
+            fake.wait()
+            if url.path.startswith('/apiv2/') and not fake.is_authorized(self.headers.get('Authorization')):
+                self.send_body(401, {'error': 'unauthorized'})
+            elif url.path == '/apiv2/alert':
+                if fake.churn:
+                    fake.new_cycle()
+                self.send_json(fake.alert_list())
+            elif DASHBOARD_RE.match(url.path):
+                alert_id = DASHBOARD_RE.match(url.path).group(1)
+                if alert_id not in fake.alerts:
+                    return self.send_body(404, {'error': 'not found'})
+                if fake.fails(fake.dashboard_error_rate):
+                    return self.send_error_status()
+                self.send_json(fake.dashboard(alert_id, int(query.get('page', ['1'])[0])))
+            elif url.path == '/alert_result_view_ad':
+                if fake.fails(fake.error_rate):
+                    return self.send_error_status()
+                ad = fake.ads.get(query.get('ad', [''])[0])
+                if ad is None:
+                    return self.send_body(404, b'', 'text/html')
+                self.send_body(302, b'', 'text/html', headers={'Location': f'/sources/{ad["source"]}/{ad["id"]}'})
+            elif SOURCE_RE.match(url.path):
+                self.send_body(200, fake.source_page, 'text/html; charset=utf-8')
+            else:
+                self.send_body(404, {'error': 'not found'})
+
+    return FakeJinkaHandler
+
+
+class FakeJinkaServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def handle_error(self, request, client_address):
+        # Streamed responses are closed by the client without reading the body, which resets the connection.
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def serve(host='127.0.0.1', port=8765, ready=None, **kwargs):
+    server = FakeJinkaServer((host, port), make_handler(FakeJinka(**kwargs)))
+    if ready is not None:
+        ready.put(server.server_port)
+    server.serve_forever()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Local stand-in of the Jinka API serving synthetic alerts.')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('-n', '--nb-ads', type=int, default=1000)
+    parser.add_argument('--nb-alerts', type=int, default=4)
+    parser.add_argument('--ads-per-page', type=int, default=30)
+    parser.add_argument('--latency', type=float, default=0, help='Mean latency of every response, in seconds.')
+    parser.add_argument('--error-rate', type=float, default=0, help='Share of link and abuse requests answered with a 503.')
+    parser.add_argument('--dashboard-error-rate', type=float, default=0, help='Share of dashboard requests answered with a 503.')
+    parser.add_argument('--source-page-size', type=int, default=64 * 1024)
+    parser.add_argument('--token-lifetime', type=int, default=0, help='Lifetime in seconds of the access tokens, 0 never expires.')
+    parser.add_argument('--churn', type=int, default=0,
+                        help='Number of new ads, rent changes and expirations of each alert every time the alerts are listed.')
+    parser.add_argument('--duplicates', type=float, default=0, help='Share of the flats also listed on another portal under a new id.')
+    parser.add_argument('--shared', type=float, default=0, help='Share of the ads also found by another alert.')
+    args = parser.parse_args()
+    print(f'Serving {args.nb_ads} synthetic ads on http://127.0.0.1:{args.port}, '
+          f'run main.py with KAJIN_API_ROOT=http://127.0.0.1:{args.port}')
+    serve(port=args.port, nb_ads=args.nb_ads, nb_alerts=args.nb_alerts, ads_per_page=args.ads_per_page, latency=args.latency,
+          error_rate=args.error_rate, dashboard_error_rate=args.dashboard_error_rate, source_page_size=args.source_page_size,
+          token_lifetime=args.token_lifetime, churn=args.churn, duplicates=args.duplicates, shared=args.shared)
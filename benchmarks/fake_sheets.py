@@ -0,0 +1,41 @@
+import re
+import sys
+import os
+from collections import Counter
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'src'))
+
+from sheets_utils import sheet_rows
+
+RANGE_RE = re.compile(r"^'(.+)'!([A-Z]+)(\d+):([A-Z]+)(\d+)$")
+
+
+class FakeSheetsUploader:
+    # In-memory stand-in of the uploader interface used by sheets_utils.sync_table: worksheets are lists of rows.
+    def __init__(self):
+        self.worksheets = {}
+        self.calls = Counter()
+        self.cells_sent = 0
+
+    def push_table(self, df, spreadsheet_id, worksheet_name, index=True):
+        header, rows = sheet_rows(df)
+        self.worksheets[worksheet_name] = [header] + list(rows.values())
+        self.calls['push_table'] += 1
+        self.cells_sent += len(header) * (len(rows) + 1)
+
+    def update_ranges(self, spreadsheet_id, data):
+        self.calls['update_ranges'] += 1
+        for value_range in data:
+            worksheet_name, _, first_row, _, last_row = RANGE_RE.match(value_range['range']).groups()
+            worksheet = self.worksheets[worksheet_name]
+            assert int(last_row) - int(first_row) + 1 == len(value_range['values'])
+            for offset, values in enumerate(value_range['values']):
+                row = int(first_row) + offset - 1
+                worksheet.extend([] for _ in range(row + 1 - len(worksheet)))
+                worksheet[row] = list(values)
+                self.cells_sent += len(values)
+
+    def table(self, worksheet_name):
+        # Content of the worksheet as a full push would write it, blank rows and row order aside.
+        header, *rows = self.worksheets[worksheet_name]
+        return header, {str(values[0]): values for values in rows if any(value != '' for value in values)}
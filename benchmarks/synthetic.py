@@ -0,0 +1,44 @@
+import random
+from datetime import datetime, timedelta
+
+SOURCES = ['pap', 'seloger', 'leboncoin', 'logic-immo', 'century21', 'meilleursagents', 'locservice', 'lagenceblue',
+           'paruvendu', 'laforet', 'orpi', 'avendrealouer', 'fnaim', 'locatair', 'bienici', 'flatlooker']
+STATIONS = ['Bastille', 'Nation', 'République', 'Oberkampf', 'Parmentier', 'Voltaire', 'Gambetta', 'Jourdain', 'Belleville',
+            'Pyrénées', 'Goncourt', 'Bréguet-Sabin', 'Richard-Lenoir', 'Saint-Ambroise', 'Charonne', 'Philippe Auguste']
+LINES = ['1', '2', '3', '5', '8', '9', '11']
+
+
+def synthetic_ad(ad_id, alert_id, rng=random):
+    postal_code = f'750{rng.randint(1, 20):02d}'
+    area = round(rng.uniform(15, 90), 1)
+    rent = rng.randint(600, 3000)
+    send_date = datetime(2021, 3, 1) + timedelta(minutes=rng.randint(0, 60 * 24 * 60))
+    stops = [{'name': rng.choice(STATIONS), 'lines': rng.sample(LINES, rng.randint(1, 3))} for _ in range(rng.randint(0, 4))]
+    return {
+        'id': ad_id, 'source': rng.choice(SOURCES), 'source_is_partner': rng.random() < 0.2,
+        'source_logo': 'https://static.jinka.fr/logo.png', 'source_label': 'Label', 'search_type': 'for_rent',
+        'owner_type': rng.choice(['Particulier', 'Agence']), 'rent': rent, 'rent_max': None, 'area': area,
+        'room': rng.randint(1, 5), 'bedroom': rng.randint(0, 3), 'floor': rng.randint(0, 8), 'type': 'Appartement',
+        'buy_type': None, 'city': 'Paris', 'postal_code': postal_code, 'lat': round(rng.uniform(48.81, 48.90), 6),
+        'lng': round(rng.uniform(2.25, 2.42), 6), 'furnished': rng.random() < 0.5,
+        'description': 'Bel appartement lumineux. ' * rng.randint(5, 40), 'description_is_truncated': True,
+        'images': [f'https://static.jinka.fr/{ad_id}/{i}.jpg' for i in range(rng.randint(1, 10))],
+        'created_at': send_date.isoformat() + '.000Z', 'expired_at': None if rng.random() < 0.95 else send_date.isoformat() + '.000Z',
+        'sendDate': send_date.isoformat() + '.000Z', 'previous_rent': rent + rng.randint(10, 100) if rng.random() < 0.1 else None,
+        'previous_rent_at': None, 'favorite': False, 'nb_spam': 0, 'contacted': False, 'stops': stops,
+        'features': {'id': ad_id, 'year': rng.randint(1850, 2020), 'box': rng.random() < 0.1, 'balcony': rng.random() < 0.3,
+                     'elevator': rng.random() < 0.5, 'parking': rng.random() < 0.1},
+        'new_real_estate': False, 'rentMinPerM2': round(rent / area, 2), 'clicked_at': None,
+        'webview_link': f'https://www.jinka.fr/alert_result_view_ad?ad={ad_id}', 'alert_id': alert_id,
+        'source_description': 'Annonce',
+    }
+
+
+def synthetic_pages(nb_ads, ads_per_page=30, nb_alerts=4, seed=0):
+    rng = random.Random(seed)
+    pages = []
+    for start in range(0, nb_ads, ads_per_page):
+        alert_id = f'alert{(start // ads_per_page) % nb_alerts}'
+        ads = [synthetic_ad(ad_id, alert_id, rng) for ad_id in range(start, min(start + ads_per_page, nb_ads))]
+        pages.append((alert_id, start // ads_per_page + 1, ads))
+    return pages
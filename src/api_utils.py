@@ -1,23 +1,110 @@
 import pandas as pd
+import numpy as np
 import requests
 import os
+import json
 import time
-from datetime import datetime
-from bs4 import BeautifulSoup
-from tqdm import tqdm, trange
+import asyncio
+import random
+import base64
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta, timezone
+from email.utils import parsedate_to_datetime
+from requests.adapters import HTTPAdapter
+from tqdm import tqdm
 from logzero import logger
 
-def authenticate(email, password):
-    auth_url = 'https://api.jinka.fr/apiv2/user/auth'
+from cache_utils import CachingAdapter
+from expiration_utils import check_expiration
+
+# Can be pointed to a local stand-in of the Jinka API, see benchmarks/fake_jinka.py.
+API_ROOT = os.environ.get('KAJIN_API_ROOT', 'https://api.jinka.fr')
+
+# Fields dropped by processing_utils.cleaner, they are left out as soon as the ads are collected.
+APPARTS_DROPPED_FIELDS = {'source_logo', 'source_label', 'search_type', 'rent_max', 'bedroom', 'buy_type', 'new_real_estate',
+    'webview_link', 'source_description'}
+
+APPARTS_COLUMNS = ['id', 'source', 'source_is_partner', 'owner_type', 'rent', 'area', 'room', 'floor', 'type', 'city', 'postal_code',
+    'lat', 'lng', 'furnished', 'description', 'description_is_truncated', 'images', 'created_at', 'expired_at', 'sendDate',
+    'previous_rent', 'previous_rent_at', 'favorite', 'nb_spam', 'contacted', 'stops', 'features', 'rentMinPerM2', 'clicked_at',
+    'alert_id', 'page']
+
+# Repetitive strings are stored as categoricals, numbers as nullable dtypes so that missing values do not turn them into floats.
+APPARTS_DTYPES = {'source': 'category', 'owner_type': 'category', 'type': 'category', 'city': 'category', 'postal_code': 'category',
+    'alert_id': 'category', 'rent': 'Int64', 'area': 'Float64', 'room': 'Int8', 'floor': 'Int16', 'lat': 'Float64', 'lng': 'Float64',
+    'previous_rent': 'Int64', 'nb_spam': 'Int32', 'rentMinPerM2': 'Float64', 'page': 'Int32'}
+
+def to_nullable_numeric(values, dtype):
+    values = pd.to_numeric(values, errors='coerce')
+    # Integer columns holding decimals or out of range values are kept as floats rather than truncated.
+    if dtype.startswith('Int'):
+        values_present = values.dropna()
+        info = np.iinfo(dtype.lower())
+        if not ((values_present % 1 == 0).all() and values_present.between(info.min, info.max).all()):
+            dtype = 'Float64'
+    return values.astype(dtype)
+
+class AppartsAccumulator:
+    # Collects the ads column by column and builds a single DataFrame at the end, instead of copying
+    # a growing DataFrame for every page. Dropped fields are never stored.
+    def __init__(self, columns=APPARTS_COLUMNS, dtypes=APPARTS_DTYPES, dropped_fields=APPARTS_DROPPED_FIELDS):
+        self.columns = {column: [] for column in columns}
+        self.dtypes = dtypes
+        self.dropped_fields = dropped_fields
+        self.nb_rows = 0
+
+    def add(self, ad):
+        for key in ad.keys() - self.columns.keys() - self.dropped_fields:
+            self.columns[key] = [None] * self.nb_rows
+        for key, column in self.columns.items():
+            column.append(ad.get(key))
+        self.nb_rows += 1
+
+    def extend(self, ads):
+        for ad in ads:
+            self.add(ad)
+
+    def to_df(self):
+        df = pd.DataFrame(self.columns, columns=list(self.columns))
+        for column, dtype in self.dtypes.items():
+            if column not in df.columns:
+                continue
+            if dtype == 'category':
+                df[column] = df[column].astype('category')
+            else:
+                df[column] = to_nullable_numeric(df[column], dtype)
+        return df
+
+def request_token(session, email, password):
+    auth_url = API_ROOT + '/apiv2/user/auth'
     auth_dict = {'email':email, 'password':password}
-    s = requests.Session()
-    r_auth = s.post(auth_url, auth_dict)
+    r_auth = session.post(auth_url, auth_dict)
     if r_auth.status_code == 200:
         logger.info('Authentification succeeded (200)')
-        access_token = r_auth.json()['access_token']
-    else:
-        logger.critical(f'Authentification failed with error {r_auth.status_code}')
+        return r_auth.json()['access_token']
+    logger.critical(f'Authentification failed with error {r_auth.status_code}')
+    return None
+
+def token_expiration(access_token):
+    # The access token is a JWT, its payload is only decoded to know when to authenticate again.
+    try:
+        payload = access_token.split('.')[1]
+        payload = json.loads(base64.urlsafe_b64decode(payload + '=' * (-len(payload) % 4)))
+        return datetime.fromtimestamp(payload['exp'], timezone.utc)
+    except (IndexError, KeyError, TypeError, ValueError):
+        return None
+
+def authenticate(email, password, pool_size=16, cache_path=None, cache_max_size=100*1024*1024):
+    s = requests.Session()
+    s.mount('https://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    s.mount('http://', HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size))
+    if cache_path is not None:
+        s.mount(API_ROOT + '/', CachingAdapter(cache_path, cache_max_size, pool_connections=pool_size, pool_maxsize=pool_size))
+    access_token = request_token(s, email, password)
+    if access_token is None:
         return None, None
+    s.token_expires_at = token_expiration(access_token)
 
     headers = {
     'Accept': '*/*',
@@ -29,14 +116,52 @@ def authenticate(email, password):
     'Connection': 'keep-alive',
     'DNT': '1',
     'Sec-GPC': '1',
-    'If-None-Match': 'W/f46-qWZd5Nq9sjWAv9cj3oEhFaxFuek',
     'TE': 'Trailers',
     }
 
     return s, headers
 
-def get_alerts(session, headers):
-    r_alerts = session.get('https://api.jinka.fr/apiv2/alert', headers=headers)
+def refresh_authentication(session, headers, email, password):
+    access_token = request_token(session, email, password)
+    if access_token is None:
+        return False
+    # The headers are updated in place, since the same dict is passed to every API call.
+    headers['Authorization'] = f'Bearer {access_token}'
+    session.token_expires_at = token_expiration(access_token)
+    return True
+
+def ensure_authenticated(session, headers, email, password, margin=timedelta(minutes=1)):
+    token_expires_at = getattr(session, 'token_expires_at', None)
+    if (token_expires_at is not None) and (datetime.now(timezone.utc) + margin >= token_expires_at):
+        logger.info('The access token is about to expire, authenticating again.')
+        return refresh_authentication(session, headers, email, password)
+    return True
+
+def keep_authenticated(session, headers, email, password):
+    # API calls answered with a 401 authenticate again and are sent once more with the new token.
+    lock = threading.Lock()
+    auth_url = API_ROOT + '/apiv2/user/auth'
+
+    def reauthenticate(response, *args, **kwargs):
+        if (response.status_code != 401) or (response.request.url == auth_url) or ('Authorization' not in response.request.headers):
+            return response
+        with lock:
+            # Only the first of several concurrent requests rejected with the same token authenticates again.
+            if (response.request.headers['Authorization'] == headers['Authorization']) and \
+               not refresh_authentication(session, headers, email, password):
+                return response
+        logger.info(f'Sending {response.request.method} {response.request.url} again with the new access token.')
+        response.close()
+        request = response.request.copy()
+        request.headers['Authorization'] = headers['Authorization']
+        request.hooks = {'response': []}
+        return session.send(request, **kwargs)
+
+    session.hooks['response'].append(reauthenticate)
+
+def get_alerts(session, headers, max_retries=5):
+    r_alerts = request_with_retries(session, 'GET', API_ROOT + '/apiv2/alert', 'the alerts', max_retries, headers=headers)
+    r_alerts.raise_for_status()
     df_alerts = pd.DataFrame(columns=['id', 'name', 'user_name', 'ads_per_day'])
     data_dict = {'id':[], 'name':[], 'user_name':[], 'ads_per_day':[], 'nb_pages':[], 'all':[], 'read':[],
     'unread':[], 'favorite':[], 'contact':[], 'deleted':[]}
@@ -47,9 +172,11 @@ def get_alerts(session, headers):
         data_dict['user_name'].append(alert['user_name'])
         data_dict['ads_per_day'].append(alert['estimated_ads_per_day'])
 
-        root_url = 'https://api.jinka.fr/apiv2/alert/' + str(alert['id']) + '/dashboard' 
+        root_url = API_ROOT + '/apiv2/alert/' + str(alert['id']) + '/dashboard' 
 
-        r_pagination = session.get(root_url, headers=headers)
+        r_pagination = request_with_retries(session, 'GET', root_url, f'the pagination of alert {alert["id"]}', max_retries,
+                                            headers=headers)
+        r_pagination.raise_for_status()
         pagination_data = r_pagination.json()['pagination']
         data_dict['nb_pages'].append(pagination_data['nbPages'])
         data_dict['all'].append(pagination_data['totals']['all'])
@@ -64,7 +191,44 @@ def get_alerts(session, headers):
     df_alerts = pd.DataFrame(data=data_dict)  
     return df_alerts
 
-def get_appart_response(session, row_tuple):
+RETRY_STATUS_CODES = {429, 502, 503, 504}
+
+def backoff_delay(attempt, backoff_factor=1, max_backoff=60):
+    return random.uniform(0, min(max_backoff, backoff_factor * 2 ** attempt))
+
+def retry_after_delay(response, max_backoff=60):
+    retry_after = response.headers.get('Retry-After')
+    if retry_after is None:
+        return None
+    try:
+        delay = float(retry_after)
+    except ValueError:
+        try:
+            delay = (parsedate_to_datetime(retry_after) - datetime.now(timezone.utc)).total_seconds()
+        except (TypeError, ValueError):
+            return None
+    return min(max(delay, 0), max_backoff)
+
+def request_with_retries(session, method, url, description, max_retries=5, backoff_factor=1, max_backoff=60, **kwargs):
+    for attempt in range(max_retries + 1):
+        try:
+            response = session.request(method, url, **kwargs)
+        except requests.exceptions.RequestException:
+            if attempt == max_retries:
+                raise
+            delay = backoff_delay(attempt, backoff_factor, max_backoff)
+            logger.warn(f'Connection interrupted by Jinka. Waiting {delay:.1f} seconds before retrying.')
+        else:
+            if (response.status_code not in RETRY_STATUS_CODES) or (attempt == max_retries):
+                return response
+            delay = retry_after_delay(response, max_backoff)
+            response.close()
+            if delay is None:
+                delay = backoff_delay(attempt, backoff_factor, max_backoff)
+            logger.warn(f'Received a {response.status_code} for {description}. Waiting {delay:.1f} seconds before retrying.')
+        time.sleep(delay)
+
+def get_appart_response(session, row_tuple, max_retries=5, backoff_factor=1, max_backoff=60, stream=False):
 
     alert_id = row_tuple[1]['alert_id']
     appart_id = str(row_tuple[0])
@@ -86,200 +250,321 @@ def get_appart_response(session, row_tuple):
         ('ad', appart_id),
         ('alert_token', alert_id),
     )
+    return request_with_retries(session, 'GET', API_ROOT + '/alert_result_view_ad', f'appart {appart_id}', max_retries,
+                                backoff_factor, max_backoff, headers=headers, params=params, stream=stream)
+
+def resolve_link(session, row_tuple, check_expired=False, max_retries=5):
+    # The response is streamed: its body is only read by the expiration rules which need it.
+    # A lookup still rate limited once the retries are exhausted, or refused by the Jinka redirector itself, has
+    # not reached the source website: it raises rather than returning the redirector URL as the link.
+    response = get_appart_response(session, row_tuple, max_retries, stream=True)
     try:
-        response = session.get('https://api.jinka.fr/alert_result_view_ad', headers=headers, params=params)
-    except:
-        logger.warn('Connection interrupted by Jinka. Waiting 30 seconds before retrying.')
-        time.sleep(30)
-        logger.warn('Retrying to establish the connection...')
-        response = session.get('https://api.jinka.fr/alert_result_view_ad', headers=headers, params=params)
-    return response
-
-def expired_checker(response, row_tuple):
-
-    source = row_tuple[1]['source']
-    true_expired_date = None
-
-    if source in ['logic-immo', 'century21', 'meilleursagents', 'locservice', 'lagenceblue']:
-        parsed_url = BeautifulSoup(response.text, 'html.parser')
-    elif source in ['pap', 'seloger', 'paruvendu', 'laforet', 'orpi', 'avendrealouer', 'fnaim', 'locatair']:
-        parsed_url = response.url.split('/')
-    elif source=='leboncoin':
-        true_expired_date = row_tuple[1]['expired_at']
-    else:
-        return true_expired_date
-
-    if source == 'logic-immo':
-        item = parsed_url.find_all(class_="expiredTxt")
-        if len(item)!=0:
-            true_expired_date = datetime.now()
-    
-    if source == 'pap':
-        if parsed_url[3] == 'annonce':
-            true_expired_date = datetime.now()
-
-    if source == 'seloger':
-        if parsed_url[-1] == '#expiree':
-            true_expired_date = datetime.now()
-
-    if source == 'explorimmo':
-        pass
-
-    if source == 'paruvendu':
-        if parsed_url[-1] == '#showError404':
-            true_expired_date = datetime.now()
-
-
-    if source == 'century21':
-        item = parsed_url.find_all(class_="content_msg")
-        item2 = parsed_url.find_all(class_="tw-font-semibold tw-text-lg")
-        if len(item)!=0:
-            if item[0].strong.text == "Nous sommes désolés, la page à laquelle vous tentez d'accéder n'existe pas.":
-                true_expired_date = datetime.now()
-        if len(item2)!=0:
-            if item2[0].text.strip() == "Cette annonce est désactivée, retrouvez ci-dessous une sélection de biens s'en rapprochant.":
-                true_expired_date = datetime.now()
-
-    if source == 'stephaneplaza':
-        pass
-
-    if source == 'meilleursagents':
-        item = parsed_url.find_all(class_="error-page")
-        if len(item)!=0:
-            true_expired_date = datetime.now()
-
-    if source == 'flatlooker':
-        pass
-
-    if source == 'bienici':
-        pass
-
-    if source ==  'locservice':
-        item = parsed_url.find_all(class_="louerecemment")
-        if len(item)!=0:
-            true_expired_date = datetime.now()
-
-    if source ==  'guyhoquet':
-        pass
-
-    if source == 'laforet':
-        if parsed_url[3] == 'ville':
-            true_expired_date = datetime.now()
-
-    if source == 'lagenceblue':
-        item = parsed_url.find_all(class_="label label-warning")
-        if len(item)!=0:
-            true_expired_date = datetime.now()
-        
-    if source == 'avendrealouer':
-        if '#expiree' in parsed_url[-1]:
-           true_expired_date = datetime.now()
-
-    if source == 'orpi':
-        if parsed_url[-2] == 'louer-appartement':
-           true_expired_date = datetime.now() 
-
-    if source ==  'parisattitude':
-        pass
-
-    if source == 'fnaim':
-        if len(parsed_url) >= 3:
-            if parsed_url[3] != 'annonce-immobiliere':
-                true_expired_date = datetime.now()
-        
-    if source == 'erafrance':
-        pass
-    
-    return true_expired_date
-
-
-def get_all_links(session, df, expired, appart_db_path):
-    
-    if os.path.exists(appart_db_path) and (expired==False):
-        logger.info('Found a preexisting links database.')
-        df['link'] = None
-        #df['true_expired_at'] = None
-        df_already_processed = pd.read_json(appart_db_path, orient='columns')
-        unprocessed_index = set(df.index) - set(df_already_processed.index)
-        processed_index = set(df.index).intersection(df_already_processed.index)
-        df.loc[processed_index, 'link'] = df_already_processed['link']
-        #df.loc[processed_index, 'true_expired_at'] = df_already_processed['true_expired_at']
-    else:
-        if os.path.exists(appart_db_path)==False:
-            logger.warn('No preexisting database has been found, generating a new one.')
-        elif expired:
-            logger.warn('Replacing the previous database in order to check for apparts expiration.')
-        unprocessed_index = df.index
-        df_already_processed = pd.DataFrame()
+        if (response.status_code in RETRY_STATUS_CODES) or (response.url.startswith(API_ROOT) and not response.ok):
+            response.raise_for_status()
+        true_expired_at = check_expiration(response, row_tuple) if check_expired else None
+    finally:
+        response.close()
+    return response.url, true_expired_at
+
+
+def get_all_links(session, df, expired, links_store, max_workers=8, max_retries=5, batch_size=50, refresh_after=timedelta(hours=1)):
+
+    df['link'] = None
+    df['true_expired_at'] = None
+    # When checking for expiration, only the links whose expiration was checked during the last refresh_after are
+    # reused, so that an interrupted check can be resumed without starting over.
+    checked_after = datetime.now() - refresh_after if expired else None
+    if expired:
+        logger.warn('Resolving the links again in order to check for apparts expiration.')
+    links = links_store.get_many(df.index, checked_after)
+    if len(links)!=0:
+        logger.info(f'Found {len(links)} already processed links in the links database.')
+    id_to_index = {str(appart_id): appart_id for appart_id in df.index}
+    processed_index = [id_to_index[appart_id] for appart_id in links]
+    unprocessed_index = df.index.difference(processed_index)
+    df.loc[processed_index, 'link'] = [links[str(appart_id)][0] for appart_id in processed_index]
+    if expired:
+        df.loc[processed_index, 'true_expired_at'] = [links[str(appart_id)][1] for appart_id in processed_index]
     logger.info(f'{len(unprocessed_index)} new links have been detected.')
 
     if len(unprocessed_index)!=0:
-        links = list(unprocessed_index.copy())
-        #expiration_list = list(unprocessed_index.copy())
-        idx = 0
-        for row_tuple in tqdm(df.iterrows(), total=len(df)) :
-            response = get_appart_response(session, row_tuple)
-            #true_expiration_date = expired_checker(response, row_tuple)
-            true_url = response.url
-            links[idx] = true_url
-            #expiration_list[idx] = true_expiration_date
-            #if true_expiration_date != None:
-            #    new_expired_list.append(row_tuple[0])
-            idx += 1
-        #logger.debug(f'Index of the DF : {df.index}')
-        df.loc[unprocessed_index, 'link'] = links
-        #df.loc[unprocessed_index, 'true_expired_at'] = expiration_list
-        df_to_append = df.loc[unprocessed_index, ['link']]
-        df_already_processed = df_already_processed.append(df_to_append)
-        df_already_processed.to_json(appart_db_path, orient='columns')
-        #nb_expired = len(df[df['true_expired_at'].notna()])
-        #logger.warn(f'{nb_expired} appartments have expired.')
+        links = {}
+        expiration_dict = {}
+        pending_links = []
+        failed = []
+        executor = ThreadPoolExecutor(max_workers=max_workers)
+        try:
+            futures = {executor.submit(resolve_link, session, row_tuple, expired, max_retries): row_tuple
+                       for row_tuple in df.loc[unprocessed_index].iterrows()}
+            for future in tqdm(as_completed(futures), total=len(futures)):
+                appart_id = futures[future][0]
+                try:
+                    true_url, true_expiration_date = future.result()
+                except Exception as e:
+                    # Failed lookups are not stored, so that they are tried again on the next run.
+                    logger.error(f'Could not resolve the link of appart {appart_id}: {e!r}')
+                    failed.append(appart_id)
+                    continue
+                links[appart_id] = true_url
+                expiration_dict[appart_id] = true_expiration_date
+                pending_links.append((appart_id, true_url, true_expiration_date))
+                if len(pending_links) >= batch_size:
+                    links_store.put_many(pending_links, checked=expired)
+                    pending_links = []
+        finally:
+            # On interruption, the queued lookups are dropped and the links resolved so far are kept.
+            executor.shutdown(cancel_futures=True)
+            links_store.put_many(pending_links, checked=expired)
+        if failed:
+            logger.warn(f'{len(failed)} links could not be resolved, they will be retried on the next run.')
+        df.loc[unprocessed_index, 'link'] = pd.Series(links, dtype=object)
+        df.loc[unprocessed_index, 'true_expired_at'] = pd.Series(expiration_dict, dtype=object)
+    if expired:
+        nb_expired = len(df[df['true_expired_at'].notna() & df['expired_at'].isna()])
+        logger.warn(f'{nb_expired} more appartments have expired on their source website.')
+        df['expired_at'] = df['expired_at'].fillna(df['true_expired_at'])
     return df
 
 
-def remove_expired(session, df, last_deleted_path):
+class RateLimiter:
+    # Spaces out the calls made from several threads, at most rate calls per second.
+    def __init__(self, rate):
+        self.interval = 1 / rate if rate else 0
+        self.lock = threading.Lock()
+        self.next_call = time.monotonic()
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            call_at = max(now, self.next_call)
+            self.next_call = call_at + self.interval
+        if call_at > now:
+            time.sleep(call_at - now)
+
+def report_abuse(session, appart_id, alert_id, rate_limiter, max_retries=5):
+    post_url = API_ROOT + '/apiv2/alert/' + alert_id + '/abuses'
+    data = {'ad_id':appart_id, 'reason':'ad_link_404'}
+    rate_limiter.wait()
+    response = request_with_retries(session, 'POST', post_url, f'the abuse report of appart {appart_id}', max_retries, data=data)
+    response.close()
+    return response.status_code
+
+def remove_expired(session, df, last_deleted_path, journal, max_reports=15, max_workers=4, rate=2, max_retries=5, dry_run=False):
     df_expired = df.loc[df["expired_at"].notna(), :]
-    if len(df_expired)>15:
-        logger.critical('Df slicing error')
-        exit()
-    logger.info('Starting the cleaning of expired offers.')
-    for appart_id, row in tqdm(df_expired.iterrows()):
-        post_url = 'https://api.jinka.fr/apiv2/alert/' + row['alert_id'] + '/abuses'
-        data = {'ad_id':appart_id, 'reason':'ad_link_404'}
-        session.post(post_url, data=data)
+    # Apparts already reported by a previous run are only removed from the dataframe.
+    reported_ids = journal.reported_ids()
+    df_to_report = df_expired.loc[[str(appart_id) not in reported_ids for appart_id in df_expired.index], :]
+    logger.info(f'{len(df_expired)} expired appartments, {len(df_expired) - len(df_to_report)} of them were already reported.')
+    if 'group_expired_at' in df_to_report.columns:
+        # Duplicates only expired through the listing resolved for their group are removed without being reported.
+        propagated = df_to_report['group_expired_at'].notna()
+        if propagated.any():
+            logger.info(f'{propagated.sum()} of them expired with a duplicate listing and are not reported.')
+        df_to_report = df_to_report.loc[~propagated, :]
+    # The dry run lists the reports even beyond the threshold, in order to check them before raising it.
+    if dry_run:
+        for appart_id, row in df_to_report.iterrows():
+            logger.info(f'Dry run: would report appart {appart_id} of alert {row["alert_id"]}.')
+        logger.info(f'Dry run: {len(df_to_report)} appartments would have been reported.')
+        if len(df_to_report) > max_reports:
+            logger.warn(f'Dry run: {len(df_to_report)} reports exceed the safety threshold of {max_reports}, '
+                        'a real run would report nothing.')
+        return df
+    if len(df_to_report) > max_reports:
+        logger.critical(f'{len(df_to_report)} expired appartments exceed the safety threshold of {max_reports} reports, '
+                        'nothing was reported. Check the data or raise the threshold.')
+        return df
+
+    logger.info(f'Starting the cleaning of {len(df_to_report)} expired offers ({max_workers} workers, {rate} reports per second).')
+    rate_limiter = RateLimiter(rate)
+    nb_failed = 0
+    executor = ThreadPoolExecutor(max_workers=max_workers)
+    try:
+        futures = {executor.submit(report_abuse, session, appart_id, row['alert_id'], rate_limiter, max_retries): (appart_id, row['alert_id'])
+                   for appart_id, row in df_to_report.iterrows()}
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            appart_id, alert_id = futures[future]
+            try:
+                status_code = future.result()
+            except Exception as e:
+                nb_failed += 1
+                logger.error(f'The report of appart {appart_id} failed ({e!r}), it will be sent again on the next run.')
+                continue
+            if status_code < 300:
+                journal.append(appart_id, alert_id, status_code)
+            else:
+                nb_failed += 1
+                logger.error(f'The report of appart {appart_id} failed with error {status_code}, it will be sent again on the next run.')
+    finally:
+        executor.shutdown(cancel_futures=True)
     df_expired.to_json(last_deleted_path, orient='columns')
     cleaned_df = df.loc[df['expired_at'].isna(), :]
-    logger.info(f'Finished cleaning the {len(df_expired)} expired appartments.')
+    logger.info(f'Finished cleaning the {len(df_expired)} expired appartments, {nb_failed} reports failed.')
     return cleaned_df
 
-def get_apparts(session, headers, alert_id, nb_pages):
-    root_url = 'https://api.jinka.fr/apiv2/alert/' + str(alert_id) + '/dashboard' 
-    df_apparts = pd.DataFrame(columns= ['id', 'source', 'source_is_partner', 'source_logo', 'source_label', 'search_type', 'owner_type', \
-        'rent', 'rent_max', 'area', 'room', 'bedroom', 'floor', 'type', 'buy_type', 'city', 'postal_code', 'lat', 'lng',  'furnished', \
-        'description', 'description_is_truncated', 'images', 'created_at', 'expired_at', 'sendDate', 'previous_rent',  'previous_rent_at', \
-        'favorite', 'nb_spam', 'contacted', 'stops', 'features', 'new_real_estate', 'rentMinPerM2', 'clicked_at', 'webview_link', 'alert_id', \
-        'page'])
-    for page in trange(1, nb_pages+1):
-        target_url = root_url + f'?filter=all&page={page}'
-        r_apparts = session.get(target_url, headers=headers)
-        df_temp = pd.DataFrame.from_records(data=r_apparts.json()['ads'])
-        df_temp['page'] = page
-        df_apparts = df_apparts.append(df_temp)   
-    return df_apparts
-
-def get_all_apparts(df_alerts, session, headers):
-    df_final = pd.DataFrame(columns= ['id', 'source', 'source_is_partner', 'source_logo', 'source_label',
-     'search_type', 'owner_type', 'rent', 'rent_max', 'area', 'room', 'bedroom', 'floor', 'type', 'buy_type',
-      'city', 'postal_code', 'lat', 'lng',  'furnished', 'description', 'description_is_truncated', 'images',
-       'created_at', 'expired_at', 'sendDate', 'previous_rent',  'previous_rent_at', 'favorite', 'nb_spam', 'contacted',
-        'stops', 'features', 'new_real_estate', 'rentMinPerM2', 'clicked_at', 'webview_link', 'alert_id'])
-    for idx, alert in df_alerts.iterrows():
-        logger.info(f'Starting the processing of the apparts of alert n°{idx + 1}')
-        alert_id = alert['id']
-        nb_pages = alert['nb_pages']
-        df_alert = get_apparts(session, headers, alert_id, nb_pages)
-        df_final = df_final.append(df_alert)
+def get_dashboard_page(session, headers, alert_id, page, max_retries=5):
+    target_url = API_ROOT + '/apiv2/alert/' + str(alert_id) + f'/dashboard?filter=all&page={page}'
+    response = request_with_retries(session, 'GET', target_url, f'page {page} of alert {alert_id}', max_retries, headers=headers)
+    response.raise_for_status()
+    return response.json()['ads']
+
+async def fetch_dashboard_page(session, headers, alert_id, page, executor, global_semaphore, alert_semaphore):
+    loop = asyncio.get_running_loop()
+    async with alert_semaphore:
+        async with global_semaphore:
+            ads = await loop.run_in_executor(executor, get_dashboard_page, session, headers, alert_id, page)
+    return alert_id, page, ads
+
+async def stream_dashboard_pages(session, headers, alerts, executor, max_concurrency=8, max_per_alert=4):
+    # Yields the pages of every alert as they arrive, through the same semaphores as fetch_dashboards. A page also holds
+    # a slot of ahead_semaphore until it is yielded, so that at most max_concurrency pages are requested ahead of the
+    # caller and the dashboards are not downloaded much faster than they are processed.
+    global_semaphore = asyncio.Semaphore(max_concurrency)
+    ahead_semaphore = asyncio.Semaphore(max_concurrency)
+    alert_semaphores = {alert_id: asyncio.Semaphore(max_per_alert) for alert_id, _ in alerts}
+
+    async def fetch_ahead(alert_id, page):
+        await ahead_semaphore.acquire()
+        return await fetch_dashboard_page(session, headers, alert_id, page, executor, global_semaphore, alert_semaphores[alert_id])
+
+    # The alerts take turns, the slots being given in the order the pages are requested.
+    max_pages = max((nb_pages for _, nb_pages in alerts), default=0)
+    tasks = [asyncio.ensure_future(fetch_ahead(alert_id, page))
+             for page in range(1, max_pages + 1) for alert_id, nb_pages in alerts if page <= nb_pages]
+    try:
+        for next_page in asyncio.as_completed(tasks):
+            result = await next_page
+            ahead_semaphore.release()
+            yield result
+    finally:
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+def iter_dashboard_pages(session, headers, alerts, max_concurrency=8, max_per_alert=4):
+    # Runs stream_dashboard_pages on its own event loop, one page at a time, for the synchronous streaming pipeline.
+    # The requests in flight go on in the executor while the caller processes the pages.
+    loop = asyncio.new_event_loop()
+    executor = ThreadPoolExecutor(max_workers=max_concurrency)
+    pages = stream_dashboard_pages(session, headers, alerts, executor, max_concurrency, max_per_alert)
+    try:
+        while True:
+            try:
+                yield loop.run_until_complete(pages.__anext__())
+            except StopAsyncIteration:
+                return
+    finally:
+        loop.run_until_complete(pages.aclose())
+        executor.shutdown(cancel_futures=True)
+        loop.close()
+
+def load_watermarks(watermark_path, snapshot_path):
+    if not (os.path.exists(watermark_path) and os.path.exists(snapshot_path)):
+        return {}, {}
+    with open(watermark_path, 'r') as f:
+        watermarks = json.load(f)
+    with open(snapshot_path, 'r') as f:
+        snapshot = json.load(f)
+    return watermarks, snapshot
+
+def save_watermarks(records, watermark_path, snapshot_path):
+    watermarks = {}
+    for alert_id, alert_records in records.items():
+        watermarks[alert_id] = {
+            'last_send_date': max((ad['sendDate'] for ad in alert_records if ad.get('sendDate')), default=None),
+            'last_created_at': max((ad['created_at'] for ad in alert_records if ad.get('created_at')), default=None),
+            'ids': [ad['id'] for ad in alert_records],
+        }
+    with open(snapshot_path, 'w') as f:
+        json.dump(records, f)
+    with open(watermark_path, 'w') as f:
+        json.dump(watermarks, f)
+
+def is_known_ad(ad, known_ids, watermark):
+    if ad['id'] in known_ids:
+        return True
+    last_send_date = watermark['last_send_date']
+    return (last_send_date is not None) and (ad.get('sendDate') is not None) and (ad['sendDate'] < last_send_date)
+
+async def fetch_alert_pages(session, headers, alert_id, nb_pages, executor, global_semaphore, max_per_alert, progress_bar,
+                            watermark=None):
+    alert_semaphore = asyncio.Semaphore(max_per_alert)
+    pages = {}
+    first_page = 1
+    # Without a watermark, every page is requested at once. Otherwise pages are requested in waves and the
+    # paging stops as soon as a page only contains already known ads.
+    wave_size = nb_pages if watermark is None else max_per_alert
+    known_ids = set() if watermark is None else set(watermark['ids'])
+    while first_page <= nb_pages:
+        wave = range(first_page, min(first_page + wave_size, nb_pages + 1))
+        wave_results = await asyncio.gather(*[fetch_dashboard_page(session, headers, alert_id, page, executor,
+                                                                   global_semaphore, alert_semaphore) for page in wave])
+        progress_bar.update(len(wave))
+        for _, page, ads in wave_results:
+            pages[page] = ads
+        if (watermark is not None) and any(all(is_known_ad(ad, known_ids, watermark) for ad in ads)
+                                           for _, _, ads in wave_results):
+            logger.info(f'Alert {alert_id}: reached already known ads after {len(pages)} / {nb_pages} pages.')
+            break
+        first_page += len(wave)
+    return alert_id, pages
+
+async def fetch_dashboards(session, headers, alerts, max_concurrency=8, max_per_alert=4, watermarks={}):
+    global_semaphore = asyncio.Semaphore(max_concurrency)
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor, \
+         tqdm(total=sum(nb_pages for _, nb_pages in alerts)) as progress_bar:
+        results = await asyncio.gather(*[fetch_alert_pages(session, headers, alert_id, nb_pages, executor, global_semaphore,
+                                                           max_per_alert, progress_bar, watermarks.get(str(alert_id)))
+                                         for alert_id, nb_pages in alerts])
+    return dict(results)
+
+def pages_to_records(pages, previous_records=[]):
+    records = [{**ad, 'page': page} for page in sorted(pages) for ad in pages[page]]
+    new_ids = set(ad['id'] for ad in records)
+    records += [ad for ad in previous_records if ad['id'] not in new_ids]
+    return records
+
+def records_to_df(records):
+    accumulator = AppartsAccumulator()
+    accumulator.extend(records)
+    return accumulator.to_df()
+
+def run_coroutine(coroutine):
+    # asyncio.run refuses to start inside a running event loop, as in Jupyter or an async application:
+    # the coroutine then gets its own loop on a worker thread.
+    try:
+        asyncio.get_running_loop()
+    except RuntimeError:
+        return asyncio.run(coroutine)
+    with ThreadPoolExecutor(max_workers=1) as executor:
+        return executor.submit(asyncio.run, coroutine).result()
+
+def get_apparts(session, headers, alert_id, nb_pages, max_concurrency=8, max_per_alert=4, watermark=None, previous_records=[]):
+    watermarks = {} if watermark is None else {str(alert_id): watermark}
+    results = run_coroutine(fetch_dashboards(session, headers, [(alert_id, nb_pages)], max_concurrency, max_per_alert, watermarks))
+    return records_to_df(pages_to_records(results[alert_id], previous_records))
+
+def get_all_apparts(df_alerts, session, headers, max_concurrency=8, max_per_alert=4, watermark_path=None, snapshot_path=None,
+                    full=False):
+    incremental = (watermark_path is not None) and (snapshot_path is not None)
+    watermarks, snapshot = {}, {}
+    if incremental and not full:
+        watermarks, snapshot = load_watermarks(watermark_path, snapshot_path)
+        if len(watermarks)!=0:
+            logger.info('Found preexisting alert watermarks, only new dashboard pages will be fetched.')
+    alerts = list(zip(df_alerts['id'], df_alerts['nb_pages']))
+    logger.info(f'Fetching up to {df_alerts["nb_pages"].sum()} dashboard pages from {len(alerts)} alerts '
+                f'({max_concurrency} concurrent requests, {max_per_alert} per alert).')
+    results = run_coroutine(fetch_dashboards(session, headers, alerts, max_concurrency, max_per_alert, watermarks))
+    records = {}
+    accumulator = AppartsAccumulator()
+    for idx, (alert_id, nb_pages) in enumerate(alerts):
+        records[str(alert_id)] = pages_to_records(results[alert_id], snapshot.get(str(alert_id), []))
+        accumulator.extend(records[str(alert_id)])
         logger.info(f'Finished processing the apparts of alert n°{idx + 1}')
+    if incremental:
+        save_watermarks(records, watermark_path, snapshot_path)
+    df_final = accumulator.to_df()
     df_final = df_final.set_index('id')
     expired_index = df_final[df_final['expired_at'].notna()].index
     logger.warning(f"{len(expired_index)} apparts have expired.")
@@ -0,0 +1,91 @@
+import json
+import time
+import sqlite3
+import threading
+from requests.adapters import HTTPAdapter
+from requests.structures import CaseInsensitiveDict
+from logzero import logger
+
+class CachingAdapter(HTTPAdapter):
+    # Transport adapter keeping the body and validators (ETag / Last-Modified) of the GET responses on disk.
+    # Cached URLs are requested with conditional headers, and 304 answers are served from the cache.
+    # The least recently used entries are evicted when the cache grows over max_size bytes.
+    def __init__(self, cache_path, max_size=100*1024*1024, **kwargs):
+        super().__init__(**kwargs)
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.stats = {'hits': 0, 'misses': 0, 'evictions': 0}
+        self.conn = sqlite3.connect(cache_path, check_same_thread=False)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS cache (url TEXT PRIMARY KEY, etag TEXT, last_modified TEXT, headers TEXT, '
+                          'body BLOB, size INTEGER, accessed_at REAL)')
+
+    def get_entry(self, url):
+        with self.lock:
+            return self.conn.execute('SELECT etag, last_modified, headers, body FROM cache WHERE url = ?', (url,)).fetchone()
+
+    def store_entry(self, url, response):
+        body = response.content
+        with self.lock, self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO cache VALUES (?, ?, ?, ?, ?, ?, ?)',
+                              (url, response.headers.get('ETag'), response.headers.get('Last-Modified'),
+                               json.dumps(dict(response.headers)), body, len(body), time.time()))
+            self.evict()
+
+    def touch_entry(self, url):
+        with self.lock, self.conn:
+            self.conn.execute('UPDATE cache SET accessed_at = ? WHERE url = ?', (time.time(), url))
+
+    def evict(self):
+        total_size = self.conn.execute('SELECT COALESCE(SUM(size), 0) FROM cache').fetchone()[0]
+        if total_size <= self.max_size:
+            return
+        for url, size in self.conn.execute('SELECT url, size FROM cache ORDER BY accessed_at').fetchall():
+            self.conn.execute('DELETE FROM cache WHERE url = ?', (url,))
+            self.stats['evictions'] += 1
+            total_size -= size
+            if total_size <= self.max_size:
+                break
+
+    def send(self, request, stream=False, **kwargs):
+        if request.method != 'GET':
+            return super().send(request, stream=stream, **kwargs)
+        entry = self.get_entry(request.url)
+        if entry is not None:
+            etag, last_modified, headers, body = entry
+            if etag is not None:
+                request.headers['If-None-Match'] = etag
+            if last_modified is not None:
+                request.headers['If-Modified-Since'] = last_modified
+        response = super().send(request, stream=stream, **kwargs)
+        if (response.status_code == 304) and (entry is not None):
+            self.stats['hits'] += 1
+            self.touch_entry(request.url)
+            cached_headers = CaseInsensitiveDict(json.loads(headers))
+            for key in ['ETag', 'Last-Modified', 'Date', 'Cache-Control', 'Expires']:
+                if key in response.headers:
+                    cached_headers[key] = response.headers[key]
+            cached_headers.pop('Content-Encoding', None)
+            cached_headers['Content-Length'] = str(len(body))
+            response.status_code = 200
+            response.reason = 'OK'
+            response.headers = cached_headers
+            response._content = body
+            response._content_consumed = True
+            response.from_cache = True
+            return response
+        self.stats['misses'] += 1
+        # Streamed bodies are left to the caller, they are never read here.
+        if (response.status_code == 200) and (not stream) and \
+           (('ETag' in response.headers) or ('Last-Modified' in response.headers)):
+            self.store_entry(request.url, response)
+        return response
+
+    def log_stats(self):
+        nb_requests = self.stats['hits'] + self.stats['misses']
+        hit_rate = self.stats['hits'] / nb_requests if nb_requests != 0 else 0
+        logger.info(f'HTTP cache: {self.stats["hits"]} hits, {self.stats["misses"]} misses ({hit_rate:.0%} hit rate), '
+                    f'{self.stats["evictions"]} evictions.')
+
+    def close(self):
+        super().close()
+        self.conn.close()
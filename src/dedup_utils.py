@@ -0,0 +1,59 @@
+import pandas as pd
+from logzero import logger
+
+# Listings of the same flat on several portals share their postal code, and their area, rent and
+# coordinates once rounded to these steps.
+AREA_STEP = 1
+RENT_STEP = 10
+COORDS_DECIMALS = 3
+
+def drop_duplicate_ids(df):
+    # An appart found by several alerts is returned once per alert, the first one is kept.
+    duplicated = df.index.duplicated()
+    if duplicated.any():
+        logger.info(f'Dropped {duplicated.sum()} apparts found by several alerts.')
+    return df.loc[~duplicated]
+
+def blocking_keys(df, area_step=AREA_STEP, rent_step=RENT_STEP, coords_decimals=COORDS_DECIMALS):
+    numbers = lambda column: pd.to_numeric(df[column], errors='coerce').astype(float)
+    return pd.DataFrame({'postal_code': df['postal_code'].astype(object),
+                         'area': (numbers('area') / area_step).round(),
+                         'rent': (numbers('rent') / rent_step).round(),
+                         'lat': numbers('lat').round(coords_decimals),
+                         'lng': numbers('lng').round(coords_decimals)}, index=df.index)
+
+def duplicate_groups(df, area_step=AREA_STEP, rent_step=RENT_STEP, coords_decimals=COORDS_DECIMALS):
+    # Maps every appart id to the first appart of its group of near duplicates. Apparts missing
+    # a part of the key are left alone in their group. The ids are expected to be unique.
+    # A group only gathers listings of distinct portals: two listings of the same portal are two flats,
+    # for instance in the same building, so a key shared by two of them groups nothing.
+    keys = blocking_keys(df, area_step, rent_step, coords_decimals)
+    complete = keys.notna().all(axis=1).to_numpy(copy=True)
+    groups = pd.Series(df.index, index=df.index)
+    if complete.any():
+        key_ids = keys.loc[complete].groupby(list(keys.columns), sort=False).ngroup()
+        same_source = pd.DataFrame({'key': key_ids, 'source': df.loc[complete, 'source'].astype(object)}).duplicated()
+        complete[complete] = ~key_ids.isin(key_ids[same_source]).to_numpy()
+    if complete.any():
+        groups[complete] = groups[complete].groupby([keys.loc[complete, column] for column in keys.columns], sort=False).transform('first')
+    nb_groups = groups.nunique()
+    if nb_groups < len(groups):
+        logger.info(f'{len(groups)} apparts are listings of {nb_groups} distinct flats, links are resolved once per flat.')
+    return groups
+
+def share_group_links(df, df_representatives, groups, expired):
+    # Only the first appart of a group is resolved. The others keep an empty link of their own, the link of their group
+    # goes to group_link and the id of the resolved appart to duplicate_of.
+    resolved = df_representatives.loc[groups.to_numpy(), ['link', 'true_expired_at']]
+    is_representative = groups.to_numpy() == groups.index.to_numpy()
+    df['duplicate_of'] = groups.where(~is_representative)
+    df['group_link'] = resolved['link'].to_numpy()
+    df['link'] = df['group_link'].where(is_representative)
+    df['true_expired_at'] = pd.Series(resolved['true_expired_at'].to_numpy(), index=df.index).where(is_representative)
+    if expired:
+        # An expiration found for the group removes the others too, it is kept apart in group_expired_at since
+        # their own link was never checked and they are not reported.
+        group_expired_at = pd.Series(resolved['true_expired_at'].to_numpy(), index=df.index)
+        df['group_expired_at'] = group_expired_at.where(~is_representative & df['expired_at'].isna().to_numpy())
+        df['expired_at'] = df['expired_at'].fillna(df['true_expired_at']).fillna(df['group_expired_at'])
+    return df
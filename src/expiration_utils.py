@@ -0,0 +1,127 @@
+import re
+import codecs
+import pandas as pd
+from html import unescape
+from datetime import datetime
+
+CLASS_ATTRIBUTE_RE = re.compile(r'<([a-zA-Z][a-zA-Z0-9]*)\b[^>]*?\sclass\s*=\s*(?:"([^"]*)"|\'([^\']*)\')[^>]*>')
+TAG_RE = re.compile(r'<[^>]+>')
+
+def element_text(html):
+    return unescape(TAG_RE.sub('', html))
+
+class ClassSelector:
+    # Lightweight equivalent of BeautifulSoup's find_all(class_=...): a single class matches any element
+    # carrying it, several space-separated classes match the exact class attribute.
+    # The text of the first matching element (or of its first `child` tag) can also be checked.
+    def __init__(self, class_name, text=None, child=None):
+        self.class_name = class_name
+        self.text = text
+        self.child = child
+
+    def class_matches(self, class_attribute):
+        if ' ' in self.class_name:
+            return class_attribute == self.class_name
+        return self.class_name in class_attribute.split()
+
+    def first_element(self, html):
+        for match in CLASS_ATTRIBUTE_RE.finditer(html):
+            class_attribute = match.group(2) if match.group(2) is not None else match.group(3)
+            if self.class_matches(class_attribute):
+                return match
+        return None
+
+    def match(self, html):
+        element = self.first_element(html)
+        if element is None:
+            return False
+        if self.text is None:
+            return True
+        tag = element.group(1) if self.child is None else self.child
+        start = element.end() if self.child is None else html.find(f'<{self.child}', element.end())
+        if start == -1:
+            return False
+        if self.child is not None:
+            start = html.find('>', start) + 1
+        end = html.find(f'</{tag}', start)
+        if end == -1:
+            return False
+        return element_text(html[start:end]).strip() == self.text
+
+def read_html(response, is_done, max_bytes=512*1024, chunk_size=32*1024):
+    try:
+        decoder = codecs.getincrementaldecoder(response.encoding or 'utf-8')(errors='replace')
+    except LookupError:
+        # Charset declared by the source website but unknown to Python.
+        decoder = codecs.getincrementaldecoder('utf-8')(errors='replace')
+    html = ''
+    nb_bytes = 0
+    for chunk in response.iter_content(chunk_size=chunk_size):
+        html += decoder.decode(chunk)
+        nb_bytes += len(chunk)
+        if is_done(html) or (nb_bytes >= max_bytes) or ('</body>' in html[-chunk_size-7:]):
+            break
+    return html
+
+class UrlRule:
+    # Only needs the final URL after the redirections, the body is never read.
+    reads_body = False
+
+    def __init__(self, predicate):
+        self.predicate = predicate
+
+    def expiration_date(self, response, row):
+        try:
+            is_expired = self.predicate(response.url.split('/'))
+        except IndexError:
+            is_expired = False
+        return datetime.now().isoformat() if is_expired else None
+
+class HtmlRule:
+    # Reads the body until one of the selectors matches or max_bytes have been read.
+    reads_body = True
+
+    def __init__(self, selectors, max_bytes=512*1024):
+        self.selectors = selectors
+        self.max_bytes = max_bytes
+
+    def matches(self, html):
+        return any(selector.match(html) for selector in self.selectors)
+
+    def expiration_date(self, response, row):
+        is_expired = self.matches(read_html(response, self.matches, self.max_bytes))
+        return datetime.now().isoformat() if is_expired else None
+
+class JinkaRule:
+    # Relies on the expiration date already given by Jinka.
+    reads_body = False
+
+    def expiration_date(self, response, row):
+        return row['expired_at'] if pd.notna(row['expired_at']) else None
+
+EXPIRATION_RULES = {
+    'logic-immo': HtmlRule([ClassSelector('expiredTxt')]),
+    'century21': HtmlRule([
+        ClassSelector('content_msg', child='strong', text="Nous sommes désolés, la page à laquelle vous tentez d'accéder n'existe pas."),
+        ClassSelector('tw-font-semibold tw-text-lg',
+                      text="Cette annonce est désactivée, retrouvez ci-dessous une sélection de biens s'en rapprochant."),
+    ]),
+    'meilleursagents': HtmlRule([ClassSelector('error-page')]),
+    'locservice': HtmlRule([ClassSelector('louerecemment')]),
+    'lagenceblue': HtmlRule([ClassSelector('label label-warning')]),
+    'pap': UrlRule(lambda url_parts: url_parts[3] == 'annonce'),
+    'seloger': UrlRule(lambda url_parts: url_parts[-1] == '#expiree'),
+    'paruvendu': UrlRule(lambda url_parts: url_parts[-1] == '#showError404'),
+    'laforet': UrlRule(lambda url_parts: url_parts[3] == 'ville'),
+    'avendrealouer': UrlRule(lambda url_parts: '#expiree' in url_parts[-1]),
+    'orpi': UrlRule(lambda url_parts: url_parts[-2] == 'louer-appartement'),
+    'fnaim': UrlRule(lambda url_parts: url_parts[3] != 'annonce-immobiliere'),
+    'leboncoin': JinkaRule(),
+}
+
+def check_expiration(response, row_tuple, rules=EXPIRATION_RULES):
+    row = row_tuple[1]
+    rule = rules.get(row['source'])
+    if rule is None:
+        return None
+    return rule.expiration_date(response, row)
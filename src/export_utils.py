@@ -0,0 +1,169 @@
+import os
+import re
+import csv
+
+from logzero import logger
+
+# Control characters refused by openpyxl in the cells of a workbook.
+ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
+NESTED_TYPES = [list, set, tuple, dict]
+EXPORT_FORMATS = ['csv', 'xlsx', 'parquet', 'feather']
+# Formats which can be appended to chunk by chunk.
+STREAMING_FORMATS = ['csv', 'xlsx']
+
+def sanitize_for_excel(df):
+    # Single pass over the text columns: nested values are written as in the csv export, then the illegal
+    # characters are removed from every string at once.
+    df = df.copy()
+    for column in df.select_dtypes(include=['object', 'string', 'category']).columns:
+        values = df[column]
+        if values.dtype == 'category':
+            values = values.astype(object)
+        elif values.dtype != object:
+            df[column] = values.str.replace(ILLEGAL_CHARACTERS_RE, '', regex=True)
+            continue
+        types = values.map(type)
+        nested = types.isin(NESTED_TYPES)
+        is_string = nested | (types == str)
+        if not is_string.any():
+            continue
+        sanitized = values.to_numpy(copy=True)
+        sanitized[is_string.to_numpy()] = values[is_string].astype(str).str.replace(ILLEGAL_CHARACTERS_RE, '', regex=True).to_numpy()
+        df[column] = sanitized
+    return df
+
+def open_xlsx(df, sheet_name='Sheet1'):
+    # A write-only workbook streams its rows to disk, so only one chunk is held in memory besides the dataframe.
+    from openpyxl import Workbook
+    workbook = Workbook(write_only=True)
+    worksheet = workbook.create_sheet(sheet_name)
+    worksheet.append([df.index.name] + [str(column) for column in df.columns])
+    return workbook, worksheet
+
+def append_xlsx_rows(worksheet, df, chunksize=10000):
+    for start in range(0, len(df), chunksize):
+        chunk = sanitize_for_excel(df.iloc[start:start + chunksize]).astype(object)
+        chunk = chunk.where(chunk.notna(), None)
+        for row in chunk.itertuples(name=None):
+            worksheet.append(row)
+
+def write_xlsx(df, path, sheet_name='Sheet1', chunksize=10000):
+    workbook, worksheet = open_xlsx(df, sheet_name)
+    append_xlsx_rows(worksheet, df, chunksize)
+    workbook.save(path)
+
+def widen_csv(path, header, sep=';'):
+    # Rewrites the header of a csv export with more columns, the rows already written get empty values for them.
+    # The csv module keeps the quoted values, descriptions included, as they were written.
+    tmp_path = path + '.tmp'
+    with open(path, 'r', newline='', encoding='utf-8') as source, open(tmp_path, 'w', newline='', encoding='utf-8') as target:
+        rows = csv.reader(source, delimiter=sep)
+        writer = csv.writer(target, delimiter=sep, lineterminator=os.linesep)
+        next(rows, None)
+        writer.writerow(header)
+        for row in rows:
+            writer.writerow(row + [''] * (len(header) - len(row)))
+    os.replace(tmp_path, path)
+
+def widen_xlsx(path, header):
+    # Same for a saved workbook, which is copied row by row since a write-only worksheet can not be edited.
+    from openpyxl import Workbook, load_workbook
+    tmp_path = path + '.tmp'
+    source = load_workbook(path, read_only=True)
+    try:
+        source_sheet = source.worksheets[0]
+        workbook = Workbook(write_only=True)
+        worksheet = workbook.create_sheet(source_sheet.title)
+        rows = source_sheet.iter_rows(values_only=True)
+        next(rows, None)
+        worksheet.append(header)
+        for row in rows:
+            worksheet.append(list(row) + [None] * (len(header) - len(row)))
+        workbook.save(tmp_path)
+    finally:
+        source.close()
+    os.replace(tmp_path, path)
+
+def to_columnar(df):
+    # Arrow has no set type, the sets of metro lines are stored as lists.
+    df = df.copy()
+    for column in df.select_dtypes(include=['object']).columns:
+        is_set = (df[column].map(type) == set).to_numpy()
+        if is_set.any():
+            values = df[column].to_numpy(copy=True)
+            for position in is_set.nonzero()[0]:
+                values[position] = sorted(values[position])
+            df[column] = values
+    return df
+
+def write_export(df, path, export_format, sep=';'):
+    if export_format == 'csv':
+        df.to_csv(path, sep=sep, encoding='utf-8')
+    elif export_format == 'xlsx':
+        write_xlsx(df, path)
+    elif export_format == 'parquet':
+        to_columnar(df).to_parquet(path, engine='pyarrow')
+    elif export_format == 'feather':
+        to_columnar(df).reset_index().to_feather(path)
+    else:
+        raise ValueError(f'Unknown export format {export_format}')
+
+def export_df(df, paths, formats, sep=';'):
+    for export_format in formats:
+        try:
+            write_export(df, paths[export_format], export_format, sep)
+        except ImportError as e:
+            # Parquet and Feather rely on pyarrow, which is an optional dependency.
+            logger.error(f'Skipping the {export_format} export, a dependency is missing: {e}')
+            continue
+        logger.info(f'Exported {len(df)} apparts to {paths[export_format]}')
+
+class StreamingExport:
+    # Exports written chunk by chunk: rows are appended to the csv file as soon as they are processed, and streamed
+    # to the xlsx workbook which is saved on close. The feature keys vary between ads, so the columns found after
+    # the first chunk are added at the end of the exports and the rows already written get empty values for them.
+    def __init__(self, paths, formats, sep=';'):
+        skipped_formats = [export_format for export_format in formats if export_format not in STREAMING_FORMATS]
+        if len(skipped_formats) != 0:
+            logger.warning(f'The {", ".join(skipped_formats)} exports can not be written chunk by chunk, they are skipped.')
+        self.formats = [export_format for export_format in formats if export_format in STREAMING_FORMATS]
+        self.paths = paths
+        self.sep = sep
+        self.columns = None
+        self.index_name = None
+        self.nb_xlsx_columns = 0
+        self.workbook, self.worksheet = None, None
+        self.nb_rows = 0
+
+    def header(self):
+        return [self.index_name] + [str(column) for column in self.columns]
+
+    def append(self, df):
+        header = self.columns is None
+        if header:
+            self.columns = list(df.columns)
+            self.index_name = df.index.name
+        new_columns = [column for column in df.columns if column not in self.columns]
+        if len(new_columns) != 0:
+            logger.info(f'The columns {", ".join(map(str, new_columns))} were not in the previous chunks, they are added to the exports.')
+            self.columns += new_columns
+            if 'csv' in self.formats:
+                widen_csv(self.paths['csv'], self.header(), self.sep)
+        df = df.reindex(columns=self.columns)
+        if 'csv' in self.formats:
+            df.to_csv(self.paths['csv'], sep=self.sep, encoding='utf-8', mode='w' if header else 'a', header=header)
+        if 'xlsx' in self.formats:
+            if self.workbook is None:
+                self.workbook, self.worksheet = open_xlsx(df)
+                self.nb_xlsx_columns = len(self.columns)
+            append_xlsx_rows(self.worksheet, df)
+        self.nb_rows += len(df)
+
+    def close(self):
+        if self.workbook is not None:
+            self.workbook.save(self.paths['xlsx'])
+            self.workbook, self.worksheet = None, None
+            if self.nb_xlsx_columns < len(self.columns):
+                widen_xlsx(self.paths['xlsx'], self.header())
+        for export_format in self.formats:
+            logger.info(f'Exported {self.nb_rows} apparts to {self.paths[export_format]}')
@@ -0,0 +1,67 @@
+from api_utils import ensure_authenticated, get_alerts, get_all_apparts, get_all_links
+from processing_utils import cleaner, features_engineering
+from storage_utils import LinksStore
+from pipeline import Workspace, open_session
+from dedup_utils import drop_duplicate_ids
+
+class Kajin:
+    # Headless client of the Jinka API, for use from other scripts. Nothing happens on import or creation:
+    # the session is opened on the first call, and only the databases and data folders of the workspace are written.
+    def __init__(self, email, password, root='.', account=None, concurrency=8, alert_concurrency=4, link_workers=8,
+                 max_retries=5, cache_size=100):
+        self.email = email
+        self.password = password
+        self.workspace = Workspace(root, account)
+        self.concurrency = concurrency
+        self.alert_concurrency = alert_concurrency
+        self.link_workers = link_workers
+        self.max_retries = max_retries
+        self.cache_size = cache_size
+        self.session = None
+        self.headers = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def login(self):
+        if self.session is not None:
+            ensure_authenticated(self.session, self.headers, self.email, self.password)
+            return self.session, self.headers
+        self.workspace.makedirs()
+        session, headers = open_session(self.workspace, self.email, self.password, max(self.concurrency, self.link_workers),
+                                        self.cache_size)
+        self.session, self.headers = session, headers
+        return session, headers
+
+    def fetch_alerts(self):
+        session, headers = self.login()
+        return get_alerts(session, headers)
+
+    def fetch_apparts(self, df_alerts=None, full=False, process=True, keep_coords=False):
+        # Like the command line, only the new dashboard pages are fetched unless full is set. keep_coords keeps the
+        # numeric lat and lng columns next to geo_coords.
+        session, headers = self.login()
+        if df_alerts is None:
+            df_alerts = get_alerts(session, headers)
+        df_apparts, _ = get_all_apparts(df_alerts, session, headers, self.concurrency, self.alert_concurrency,
+                                        self.workspace.watermark_path, self.workspace.snapshot_path, full=full)
+        df_apparts = drop_duplicate_ids(df_apparts)
+        if process:
+            df_apparts = features_engineering(cleaner(df_apparts), keep_coords)
+        return df_apparts
+
+    def resolve_links(self, df_apparts, check_expired=False):
+        session, _ = self.login()
+        links_store = LinksStore(self.workspace.links_db_path, self.workspace.apparts_db_path)
+        try:
+            return get_all_links(session, df_apparts, check_expired, links_store, self.link_workers, self.max_retries)
+        finally:
+            links_store.close()
+
+    def close(self):
+        if self.session is not None:
+            self.session.close()
+            self.session, self.headers = None, None
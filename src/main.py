@@ -1,16 +1,11 @@
 import json
 import argparse
 import os
-import warnings
-import re
+from functools import partial
 
-import PySimpleGUI as sg
-from gsheets_uploader import Uploader
 from logzero import logger, logfile
 
-from api_utils import authenticate, get_alerts, get_all_apparts, get_all_links, remove_expired
-from processing_utils import features_engineering, cleaner, update_history_df, append_history_df
-from openpyxl.utils.exceptions import IllegalCharacterError
+from export_utils import EXPORT_FORMATS
 
 parser = argparse.ArgumentParser(description='Override the GUI if needed.')
 # parser.add_argument('override', metavar='N', type=bool, nargs='+',
@@ -23,82 +18,78 @@ parser.add_argument('-l', '--load', type=int, nargs='?',
                     help='Whether to load existing credentials: 0 or 1')
 parser.add_argument('-s', '--save', type=int, nargs='?',
                     help='Whether to save the credentials. It requires the email and password parameters.')
-parser.add_argument('-x', '--expired', nargs='?', const=1,
+parser.add_argument('-x', '--expired', type=int, nargs='?', const=1,
                     help='Whether to remove expired offers.')
+parser.add_argument('--max-reports', type=int, default=15,
+                    help='Safety threshold: no expired offer is reported when more than this number would be reported at once.')
+parser.add_argument('--dry-run', action='store_true',
+                    help='Only log the expired offers which would be reported to Jinka.')
+parser.add_argument('--report-workers', type=int, default=4,
+                    help='Maximum number of expired offers reported at the same time.')
+parser.add_argument('--report-rate', type=float, default=2,
+                    help='Maximum number of expired offers reported per second.')
 parser.add_argument('-u', '--upload', nargs='?', const=1,
                     help='Whether to use the gsheets-uploader package to upload to Google Sheets.')
-
-
-args = parser.parse_args()
-
-
-current_dir = os.getcwd()
-path_list = current_dir.split(os.sep)
-
-if path_list[-1]=='src':
-    current_dir = os.path.join(current_dir, '..')
-    os.chdir(current_dir)
-
-# Path to files 
-
-CREDENTIALS_FILE = os.path.join(os.getcwd(), 'databases', 'credentials.json')
-APPARTS_DB_PATH =  os.path.join(os.getcwd(), 'databases', 'appart_links_db.json')
-LAST_DELETED_PATH = os.path.join(os.getcwd(), 'databases', 'last_deleted_apparts.json')
-HISTORY_PATH = os.path.join(os.getcwd(), 'data', 'history.csv')
-APPARTS_CSV_PATH = os.path.join(os.getcwd(), 'data', 'apparts.csv')
-APPARTS_XLSX_PATH = os.path.join(os.getcwd(), 'data', 'apparts.xlsx')
-LOG_PATH = os.path.join(os.getcwd(), 'databases', 'logs.log')
-DATABASES_PATH = os.path.join(os.getcwd(), 'databases')
-DATA_PATH = os.path.join(os.getcwd(), 'data')
-CREDS_PATH = os.path.join(os.getcwd(), '..', '..', 'gsheets_credentials') 
-TOKEN_FILE_PATH = os.path.join(CREDS_PATH, 'token.json')
-SECRET_CLIENT_PATH = os.path.join(CREDS_PATH, 'secret_client.json')
-EXPORT_CSV_PATH = APPARTS_CSV_PATH
-
-if os.path.exists(LOG_PATH):
-    os.remove(LOG_PATH)
-
-if not os.path.exists(DATABASES_PATH):
-    os.mkdir(DATABASES_PATH)
-
-if not os.path.exists(DATA_PATH):
-    os.mkdir(DATA_PATH)
-
-logfile(LOG_PATH)
-
-def run_all(email, password, expired):
-    s, headers = authenticate(email, password)
-
-    if s==None:
-        logger.critical('Aborting search, check your credentials.')
-        quit()
-    df_alerts = get_alerts(s, headers)
-    df_apparts, expired_index = get_all_apparts(df_alerts, s, headers)
-    df_apparts = cleaner(df_apparts)
-    df_apparts = features_engineering(df_apparts)
-    df_history = append_history_df(df_apparts, HISTORY_PATH)
-    df_apparts = df_apparts.loc[~df_apparts.index.duplicated()]
-    df_apparts = get_all_links(s, df_apparts, expired, APPARTS_DB_PATH)
-    if expired:
-        df_history = update_history_df(df_apparts, df_history, expired_index)
-        df_apparts = remove_expired(s, df_apparts, LAST_DELETED_PATH)
-    df_apparts.to_csv(APPARTS_CSV_PATH, sep=';', encoding='utf-8')
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-        try:
-            df_apparts.to_excel(APPARTS_XLSX_PATH, encoding='utf-8')
-        except IllegalCharacterError as e:
-            logger.warn("Some illegal characters were replaced in the dataframe.")
-            ILLEGAL_CHARACTERS_RE = re.compile(r'[\000-\010]|[\013-\014]|[\016-\037]')
-            df_apparts.applymap(lambda x: ILLEGAL_CHARACTERS_RE.sub(r'', x) if isinstance(x, str) else x).to_excel(APPARTS_XLSX_PATH, encoding='utf-8')
-
-    df_history.to_csv(HISTORY_PATH, sep=';', encoding='utf-8')
-
-    if upload:
-        uploader = Uploader(credentials_path=CREDS_PATH, token_file_path=TOKEN_FILE_PATH, secret_client_path=SECRET_CLIENT_PATH)
-        uploader.push_table(df_apparts, spreadsheet_id='131UoWqQwZfydMJ3yqVe-L6TY6NKtJx8zVNppo034dT4', worksheet_name='apparts', index=True)
-
-def create_main_window(credentials_file=CREDENTIALS_FILE):
+parser.add_argument('--full-upload', action='store_true',
+                    help='Push the whole worksheet instead of the rows which changed since the last upload.')
+parser.add_argument('-c', '--concurrency', type=int, default=8,
+                    help='Maximum number of dashboard pages fetched at the same time.')
+parser.add_argument('--alert-concurrency', type=int, default=4,
+                    help='Maximum number of dashboard pages of a single alert fetched at the same time.')
+parser.add_argument('-w', '--link-workers', type=int, default=8,
+                    help='Maximum number of appart links resolved at the same time.')
+parser.add_argument('-r', '--max-retries', type=int, default=5,
+                    help='Maximum number of retries when resolving an appart link.')
+parser.add_argument('--no-dedup', action='store_true',
+                    help='Resolve the link of every listing, even when the same flat is listed on several portals.')
+parser.add_argument('--keep-coords', action='store_true',
+                    help='Keep the numeric lat and lng columns next to geo_coords in the exports.')
+parser.add_argument('--history-backend', choices=['sqlite', 'csv'], default='sqlite',
+                    help='Where the history of the apparts is stored. It is exported to data/history.csv in both cases.')
+parser.add_argument('--cache-size', type=int, default=100,
+                    help='Maximum size in MB of the HTTP cache of the Jinka API responses. 0 disables the cache.')
+parser.add_argument('--profile', choices=['cprofile', 'pyinstrument'],
+                    help='Profile the run, the stats are written to databases/run_profile.prof or run_profile.html.')
+parser.add_argument('--trace-memory', action='store_true',
+                    help='Also trace the memory allocated by each stage in databases/run_report.json, which slows down the run.')
+parser.add_argument('-f', '--full', type=int, nargs='?', const=1,
+                    help='Whether to re-scan every dashboard page instead of only the new ones.')
+parser.add_argument('--formats', nargs='+', choices=EXPORT_FORMATS, default=['csv', 'xlsx'],
+                    help='Formats of the apparts export in the data folder. Parquet and feather require pyarrow.')
+parser.add_argument('--accounts', metavar='CONFIG',
+                    help='JSON file listing several accounts, run in parallel and merged into data/apparts and data/history.csv.')
+parser.add_argument('--account-workers', type=int,
+                    help='Maximum number of accounts run at the same time, one process each. Defaults to the number of accounts.')
+parser.add_argument('--watch', type=int, metavar='INTERVAL',
+                    help='Keep running and poll the alerts every INTERVAL seconds, writing the changes of each cycle to data/deltas.')
+parser.add_argument('--full-every', type=int, default=12,
+                    help='In watch mode, re-scan every dashboard page once every N cycles to detect expirations. 0 never does.')
+parser.add_argument('--stream', action='store_true',
+                    help='Process the dashboard pages by chunks as they arrive and append them to the csv and xlsx exports.')
+parser.add_argument('--chunk-size', type=int, default=500,
+                    help='In streaming mode, number of apparts processed and exported at once.')
+
+
+def upload_apparts(df_apparts, force_full=False):
+    from sheets_utils import GoogleSheetsUploader, sync_table
+    creds_path = os.path.join(os.getcwd(), '..', '..', 'gsheets_credentials')
+    uploader = GoogleSheetsUploader(credentials_path=creds_path, token_file_path=os.path.join(creds_path, 'token.json'),
+                                    secret_client_path=os.path.join(creds_path, 'secret_client.json'))
+    # Only the rows which changed since the last upload are sent, see sheets_utils.sync_table.
+    sync_table(uploader, df_apparts, spreadsheet_id='131UoWqQwZfydMJ3yqVe-L6TY6NKtJx8zVNppo034dT4', worksheet_name='apparts',
+               snapshot_path=os.path.join(os.getcwd(), 'databases', 'sheets_snapshot.json'), force_full=force_full)
+
+def load_accounts(config_path):
+    with open(config_path, 'r') as f:
+        accounts = json.load(f)
+    for account in accounts:
+        account.setdefault('name', account['email'].split('@')[0])
+    if len(set(account['name'] for account in accounts)) != len(accounts):
+        raise ValueError(f'The account names of {config_path} must be unique, they name the data and databases sub-folders.')
+    return accounts
+
+def create_main_window(credentials_file):
+    import PySimpleGUI as sg
     sg.theme()
     if os.path.exists(credentials_file):
         with open(credentials_file, 'r') as f:
@@ -122,13 +113,43 @@ def create_main_window(credentials_file=CREDENTIALS_FILE):
     return sg.Window('Main Application', layout, size=(500, 200))
 
 if __name__=='__main__':
-    
+
+    args = parser.parse_args()
+
+    # The GUI, the pipeline and their dependencies are only imported once the arguments are valid.
+    from pipeline import Workspace, run_all, run_accounts, watch, stream
+    from metrics_utils import profile_call
+
+    current_dir = os.getcwd()
+    path_list = current_dir.split(os.sep)
+
+    if path_list[-1]=='src':
+        current_dir = os.path.join(current_dir, '..')
+        os.chdir(current_dir)
+
+    workspace = Workspace(os.getcwd())
+    CREDENTIALS_FILE = os.path.join(workspace.databases_path, 'credentials.json')
+
+    if os.path.exists(workspace.log_path):
+        os.remove(workspace.log_path)
+
+    workspace.makedirs()
+
+    logfile(workspace.log_path)
+
+    run_options = {'concurrency':args.concurrency, 'alert_concurrency':args.alert_concurrency, 'link_workers':args.link_workers,
+                   'max_retries':args.max_retries, 'full':args.full, 'history_backend':args.history_backend,
+                   'cache_size':args.cache_size, 'trace_memory':args.trace_memory, 'formats':args.formats,
+                   'dedup':not args.no_dedup, 'keep_coords':args.keep_coords}
+    report_options = {'max_reports':args.max_reports, 'max_workers':args.report_workers, 'rate':args.report_rate,
+                      'dry_run':args.dry_run}
     if (args.email==None) and (args.password == None) and (args.load == None) and (args.save == None) and (args.expired == None) \
-     and (args.upload == None):
+     and (args.upload == None) and (args.full == None) and (args.watch == None) and (args.accounts == None) and (not args.stream):
+        import PySimpleGUI as sg
         window = None
         while True:
             if window == None:
-                window = create_main_window()
+                window = create_main_window(CREDENTIALS_FILE)
                 event, credentials = window.read() 
 
             if event == 'Run Application':
@@ -138,7 +159,9 @@ if __name__=='__main__':
                 expired = credentials['-EXPIRED-']
                 upload = credentials['-UPLOAD-']
                 window.close()
-                run_all(email, password, expired=expired)
+                upload = partial(upload_apparts, force_full=args.full_upload) if upload else None
+                profile_call(args.profile, workspace.profile_path, run_all, workspace, email, password, expired=expired,
+                             report_options=report_options, upload=upload, **run_options)
                 break
 
             if event == 'Save credentials':
@@ -166,6 +189,24 @@ if __name__=='__main__':
             with open(CREDENTIALS_FILE, 'w') as f:
                 json.dump(credentials, f)
 
-        run_all(email, password, expired=args.expired)
+        upload = partial(upload_apparts, force_full=args.full_upload) if args.upload else None
+        if args.accounts is not None:
+            accounts = load_accounts(args.accounts)
+            logger.info(f'Running {len(accounts)} accounts from {args.accounts}.')
+            profile_call(args.profile, workspace.profile_path, run_accounts, workspace, accounts, args.expired,
+                         args.account_workers, run_options, report_options, upload)
+        elif args.watch is not None:
+            if args.expired:
+                logger.warn('Expired offers are not removed in watch mode, they are listed in the delta files instead.')
+            profile_call(args.profile, workspace.profile_path, watch, workspace, email, password, args.watch,
+                         full_every=args.full_every, **run_options)
+        elif args.stream:
+            if args.expired or args.upload:
+                logger.warn('Expired offers are not removed and nothing is uploaded in streaming mode, both need every appart at once.')
+            profile_call(args.profile, workspace.profile_path, stream, workspace, email, password, chunk_size=args.chunk_size,
+                         **run_options)
+        else:
+            profile_call(args.profile, workspace.profile_path, run_all, workspace, email, password, expired=args.expired,
+                         report_options=report_options, upload=upload, **run_options)
         
         
\ No newline at end of file
@@ -0,0 +1,144 @@
+import re
+import sys
+import json
+import time
+import threading
+import tracemalloc
+from datetime import datetime
+from contextlib import contextmanager
+from collections import Counter
+from urllib.parse import urlparse
+
+import numpy as np
+from logzero import logger
+
+try:
+    import resource
+except ImportError:
+    # Not available on Windows, the peak resident memory is then left out of the report.
+    resource = None
+
+ID_SEGMENT_RE = re.compile(r'/(?=[^/]*\d)[^/]{6,}|/\d+(?=/|$)')
+
+def max_rss_mb():
+    # Peak resident memory of the process so far, which Linux reports in KB and macOS in bytes.
+    if resource is None:
+        return None
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(max_rss / (1024 * 1024 if sys.platform == 'darwin' else 1024), 1)
+
+class RunMetrics:
+    # Wall time, peak resident memory and number of HTTP requests of every stage of a run, plus status codes,
+    # bytes and latencies of the HTTP requests grouped by endpoint. The peak memory allocated by each stage is
+    # only traced on demand, tracemalloc slows down the threaded stages several times.
+    def __init__(self, api_root, trace_memory=False):
+        self.api_host = urlparse(api_root).netloc
+        self.trace_memory = trace_memory
+        self.lock = threading.Lock()
+        self.started_at = datetime.now()
+        self.stages = []
+        self.endpoints = {}
+        self.nb_requests = 0
+
+    def attach(self, session):
+        session.hooks['response'].append(self.record_response)
+
+    def detach(self, session):
+        session.hooks['response'].remove(self.record_response)
+
+    def endpoint_name(self, method, url):
+        parsed_url = urlparse(url)
+        # Ads are resolved on many third party websites, which are only grouped by host.
+        if parsed_url.netloc != self.api_host:
+            return f'{method} {parsed_url.netloc}'
+        return f'{method} {ID_SEGMENT_RE.sub("/{id}", parsed_url.path)}'
+
+    def record_response(self, response, *args, **kwargs):
+        name = self.endpoint_name(response.request.method, response.url)
+        # The hook runs before the body is read, and streamed bodies are often only partly read, so the size is the one
+        # declared by the Content-Length header. Chunked responses declare none, they are counted apart.
+        content_length = response.headers.get('Content-Length')
+        with self.lock:
+            endpoint = self.endpoints.setdefault(name, {'requests': 0, 'content_length_bytes': 0, 'responses_without_length': 0,
+                                                        'cache_hits': 0, 'status_codes': Counter(), 'latencies': []})
+            endpoint['requests'] += 1
+            if content_length:
+                endpoint['content_length_bytes'] += int(content_length)
+            else:
+                endpoint['responses_without_length'] += 1
+            endpoint['cache_hits'] += int(getattr(response, 'from_cache', False))
+            endpoint['status_codes'][response.status_code] += 1
+            endpoint['latencies'].append(response.elapsed.total_seconds())
+            self.nb_requests += 1
+
+    @contextmanager
+    def stage(self, name):
+        nb_requests = self.nb_requests
+        peak_memory = None
+        if self.trace_memory:
+            tracemalloc.start()
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            wall_time = time.perf_counter() - start
+            if self.trace_memory:
+                peak_memory = tracemalloc.get_traced_memory()[1] / 1024 / 1024
+                tracemalloc.stop()
+            self.stages.append({'stage': name, 'wall_time': round(wall_time, 3), 'requests': self.nb_requests - nb_requests,
+                                'max_rss_mb': max_rss_mb(),
+                                'peak_memory_mb': None if peak_memory is None else round(peak_memory, 1)})
+            logger.debug(f'Stage {name} took {wall_time:.2f}s.')
+
+    def report(self):
+        endpoints = {}
+        for name, endpoint in self.endpoints.items():
+            p50, p90, p99 = np.percentile(endpoint['latencies'], [50, 90, 99])
+            endpoints[name] = {
+                'requests': endpoint['requests'], 'content_length_bytes': endpoint['content_length_bytes'],
+                'responses_without_length': endpoint['responses_without_length'], 'cache_hits': endpoint['cache_hits'],
+                'status_codes': {str(code): count for code, count in sorted(endpoint['status_codes'].items())},
+                'latency_p50': round(p50, 4), 'latency_p90': round(p90, 4), 'latency_p99': round(p99, 4),
+            }
+        return {
+            'started_at': self.started_at.isoformat(),
+            'wall_time': round(sum(stage['wall_time'] for stage in self.stages), 3),
+            'requests': self.nb_requests,
+            'content_length_bytes': sum(endpoint['content_length_bytes'] for endpoint in self.endpoints.values()),
+            'responses_without_length': sum(endpoint['responses_without_length'] for endpoint in self.endpoints.values()),
+            'stages': self.stages,
+            'endpoints': endpoints,
+        }
+
+    def write_report(self, report_path, **extra):
+        report = {**self.report(), **extra}
+        with open(report_path, 'w') as f:
+            json.dump(report, f, indent=2)
+        slowest_stage = max(self.stages, key=lambda stage: stage['wall_time'], default=None)
+        if slowest_stage is not None:
+            logger.info(f'Run finished in {report["wall_time"]:.1f}s with {report["requests"]} HTTP requests, '
+                        f'the slowest stage was {slowest_stage["stage"]} ({slowest_stage["wall_time"]:.1f}s). '
+                        f'Report written to {report_path}.')
+        return report
+
+def profile_call(profiler, output_path, function, *args, **kwargs):
+    if profiler == 'cprofile':
+        import cProfile
+        profile = cProfile.Profile()
+        try:
+            return profile.runcall(function, *args, **kwargs)
+        finally:
+            profile.dump_stats(output_path + '.prof')
+            logger.info(f'cProfile stats written to {output_path}.prof')
+    if profiler == 'pyinstrument':
+        from pyinstrument import Profiler
+        profile = Profiler()
+        profile.start()
+        try:
+            return function(*args, **kwargs)
+        finally:
+            profile.stop()
+            with open(output_path + '.html', 'w', encoding='utf-8') as f:
+                f.write(profile.output_html())
+            logger.info(f'pyinstrument profile written to {output_path}.html')
+    return function(*args, **kwargs)
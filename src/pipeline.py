@@ -0,0 +1,325 @@
+import os
+import json
+import time
+from datetime import datetime
+from concurrent.futures import ProcessPoolExecutor
+
+import pandas as pd
+from logzero import logger, logfile
+
+import api_utils
+from api_utils import authenticate, get_alerts, get_all_apparts, get_all_links, remove_expired, keep_authenticated, \
+    ensure_authenticated, load_watermarks, records_to_df, iter_dashboard_pages
+from processing_utils import features_engineering, cleaner, appart_changes, merge_accounts
+from dedup_utils import drop_duplicate_ids, duplicate_groups, share_group_links
+from storage_utils import open_history_store, LinksStore, AbuseJournal
+from metrics_utils import RunMetrics
+from export_utils import export_df, StreamingExport
+
+class Workspace:
+    # Files of a run: the databases folder keeps the state between runs and the data folder receives the exports.
+    # Each account of a multi-account run has its own sub-folders.
+    def __init__(self, root, account=None):
+        self.databases_path = os.path.join(root, 'databases')
+        self.data_path = os.path.join(root, 'data')
+        if account is not None:
+            self.databases_path = os.path.join(self.databases_path, account)
+            self.data_path = os.path.join(self.data_path, account)
+        self.apparts_db_path = os.path.join(self.databases_path, 'appart_links_db.json')
+        self.links_db_path = os.path.join(self.databases_path, 'appart_links_db.sqlite')
+        self.watermark_path = os.path.join(self.databases_path, 'alerts_watermark.json')
+        self.snapshot_path = os.path.join(self.databases_path, 'apparts_snapshot.json')
+        self.http_cache_path = os.path.join(self.databases_path, 'http_cache.sqlite')
+        self.last_deleted_path = os.path.join(self.databases_path, 'last_deleted_apparts.json')
+        self.abuses_journal_path = os.path.join(self.databases_path, 'abuses_journal.jsonl')
+        self.history_db_path = os.path.join(self.databases_path, 'history.sqlite')
+        self.log_path = os.path.join(self.databases_path, 'logs.log')
+        self.run_report_path = os.path.join(self.databases_path, 'run_report.json')
+        self.profile_path = os.path.join(self.databases_path, 'run_profile')
+        self.history_path = os.path.join(self.data_path, 'history.csv')
+        self.deltas_path = os.path.join(self.data_path, 'deltas')
+        self.export_paths = {export_format: os.path.join(self.data_path, f'apparts.{export_format}')
+                             for export_format in ['csv', 'xlsx', 'parquet', 'feather']}
+
+    def makedirs(self):
+        for path in [self.databases_path, self.data_path]:
+            os.makedirs(path, exist_ok=True)
+
+def open_session(workspace, email, password, pool_size=16, cache_size=100):
+    # Session of every entry point: authenticated, with the HTTP cache of the workspace, and authenticating again
+    # when its access token is refused.
+    s, headers = authenticate(email, password, pool_size=pool_size,
+                              cache_path=workspace.http_cache_path if cache_size > 0 else None, cache_max_size=cache_size*1024*1024)
+    if s is None:
+        raise RuntimeError(f'Authentification failed for {email}, check the credentials.')
+    keep_authenticated(s, headers, email, password)
+    return s, headers
+
+def run_all(workspace, email, password, expired, concurrency=8, alert_concurrency=4, link_workers=8, max_retries=5, full=False,
+            history_backend='sqlite', cache_size=100, trace_memory=False, formats=('csv', 'xlsx'), dedup=True, keep_coords=False,
+            report_options={}, upload=None):
+    metrics = RunMetrics(api_utils.API_ROOT, trace_memory=trace_memory)
+    try:
+        return run_stages(workspace, metrics, email, password, expired, concurrency, alert_concurrency, link_workers, max_retries,
+                          full, history_backend, cache_size, formats, dedup, keep_coords, report_options, upload)
+    finally:
+        metrics.write_report(workspace.run_report_path)
+
+def run_stages(workspace, metrics, email, password, expired, concurrency, alert_concurrency, link_workers, max_retries, full,
+               history_backend, cache_size, formats, dedup, keep_coords, report_options, upload):
+    with metrics.stage('authenticate'):
+        s, headers = open_session(workspace, email, password, max(concurrency, link_workers), cache_size)
+    metrics.attach(s)
+    with metrics.stage('get_alerts'):
+        df_alerts = get_alerts(s, headers)
+    with metrics.stage('get_all_apparts'):
+        # Known apparts are not re-downloaded in incremental mode, so their expiration date is only refreshed on full scans.
+        df_apparts, expired_index = get_all_apparts(df_alerts, s, headers, concurrency, alert_concurrency,
+                                                    workspace.watermark_path, workspace.snapshot_path, full=bool(full or expired))
+    with metrics.stage('dedup'):
+        df_apparts = drop_duplicate_ids(df_apparts)
+        groups = duplicate_groups(df_apparts) if dedup else None
+    with metrics.stage('cleaner'):
+        df_apparts = cleaner(df_apparts)
+    with metrics.stage('features_engineering'):
+        df_apparts = features_engineering(df_apparts, keep_coords)
+    with metrics.stage('history_merge'):
+        history_store = open_history_store(history_backend, workspace.history_path, workspace.history_db_path)
+        history_store.append(df_apparts)
+    with metrics.stage('get_all_links'):
+        links_store = LinksStore(workspace.links_db_path, workspace.apparts_db_path)
+        df_apparts = resolve_links(s, df_apparts, groups, expired, links_store, link_workers, max_retries)
+        links_store.close()
+    if expired:
+        with metrics.stage('remove_expired'):
+            expired_index = expired_index.union(df_apparts.index[df_apparts['expired_at'].notna()])
+            history_store.update_expired(df_apparts, expired_index)
+            df_apparts = remove_expired(s, df_apparts, workspace.last_deleted_path, AbuseJournal(workspace.abuses_journal_path),
+                                        max_retries=max_retries, **report_options)
+    with metrics.stage('export'):
+        export_apparts(workspace, df_apparts, formats)
+
+    with metrics.stage('history_export'):
+        history_store.export_csv(workspace.history_path)
+        history_store.close()
+
+    if cache_size > 0:
+        s.get_adapter(api_utils.API_ROOT + '/').log_stats()
+
+    if upload is not None:
+        with metrics.stage('upload'):
+            upload(df_apparts)
+    return df_apparts
+
+def resolve_links(s, df_apparts, groups, expired, links_store, link_workers=8, max_retries=5):
+    # Near duplicates listed on several portals are resolved and checked for expiration only once.
+    if groups is None:
+        return get_all_links(s, df_apparts, expired, links_store, link_workers, max_retries)
+    df_representatives = get_all_links(s, df_apparts.loc[groups.unique()], expired, links_store, link_workers, max_retries)
+    return share_group_links(df_apparts, df_representatives, groups, expired)
+
+def export_apparts(workspace, df_apparts, formats=('csv', 'xlsx')):
+    export_df(df_apparts, workspace.export_paths, formats)
+
+def to_records(df):
+    return json.loads(df.reset_index().to_json(orient='records', default_handler=list))
+
+def write_delta(workspace, started_at, df_previous, df_current, df_apparts, new_index, rent_changed_index, expired_index):
+    logger.info(f'{len(new_index)} new apparts, {len(rent_changed_index)} rent changes and {len(expired_index)} expirations.')
+    if len(new_index) + len(rent_changed_index) + len(expired_index) == 0:
+        return
+    df_rent_changes = pd.DataFrame({'previous_rent': df_previous.loc[rent_changed_index, 'rent'],
+                                    'rent': df_current.loc[rent_changed_index, 'rent']}).rename_axis(index='id')
+    delta = {'started_at': started_at.isoformat(),
+             'new': to_records(df_apparts.loc[new_index]),
+             'rent_changes': to_records(df_rent_changes),
+             'expired': to_records(df_current.loc[expired_index, ['expired_at']].rename_axis(index='id'))}
+    with open(os.path.join(workspace.deltas_path, f'delta_{started_at:%Y%m%d_%H%M%S}.json'), 'w') as f:
+        json.dump(delta, f)
+
+def run_cycle(workspace, metrics, s, headers, history_store, links_store, df_previous, df_apparts, full, concurrency,
+              alert_concurrency, link_workers, max_retries, formats, dedup=True, keep_coords=False):
+    started_at = datetime.now()
+    with metrics.stage('get_alerts'):
+        df_alerts = get_alerts(s, headers)
+    with metrics.stage('get_all_apparts'):
+        df_current, _ = get_all_apparts(df_alerts, s, headers, concurrency, alert_concurrency, workspace.watermark_path, workspace.snapshot_path,
+                                        full=full)
+        df_current = drop_duplicate_ids(df_current)
+    new_index, rent_changed_index, expired_index = appart_changes(df_previous, df_current)
+    # The first cycle processes every appart, the next ones only the new and changed apparts.
+    if df_apparts is None:
+        index_to_process = df_current.index
+    else:
+        index_to_process = new_index.union(rent_changed_index).union(expired_index)
+    if len(index_to_process) != 0:
+        with metrics.stage('dedup'):
+            groups = duplicate_groups(df_current.loc[index_to_process]) if dedup else None
+        with metrics.stage('cleaner'):
+            df_changed = cleaner(df_current.loc[index_to_process].copy())
+        with metrics.stage('features_engineering'):
+            df_changed = features_engineering(df_changed, keep_coords)
+        with metrics.stage('history_merge'):
+            history_store.append(df_changed)
+            history_store.update_expired(df_changed, expired_index)
+        with metrics.stage('get_all_links'):
+            df_changed = resolve_links(s, df_changed, groups, False, links_store, link_workers, max_retries)
+        if df_apparts is None:
+            df_apparts = df_changed
+        else:
+            df_apparts = pd.concat([df_apparts.drop(index_to_process, errors='ignore'), df_changed])
+        with metrics.stage('export'):
+            export_apparts(workspace, df_apparts, formats)
+        with metrics.stage('history_export'):
+            history_store.export_csv(workspace.history_path)
+    write_delta(workspace, started_at, df_previous, df_current, df_apparts, new_index, rent_changed_index, expired_index)
+    return df_current, df_apparts
+
+def watch(workspace, email, password, interval, concurrency=8, alert_concurrency=4, link_workers=8, max_retries=5, full=False,
+          history_backend='sqlite', cache_size=100, trace_memory=False, formats=('csv', 'xlsx'), dedup=True, keep_coords=False,
+          full_every=12):
+    s, headers = open_session(workspace, email, password, max(concurrency, link_workers), cache_size)
+    os.makedirs(workspace.deltas_path, exist_ok=True)
+    history_store = open_history_store(history_backend, workspace.history_path, workspace.history_db_path)
+    links_store = LinksStore(workspace.links_db_path, workspace.apparts_db_path)
+    # The changes of the first cycle are computed against the apparts saved by the previous run.
+    _, snapshot = load_watermarks(workspace.watermark_path, workspace.snapshot_path)
+    df_previous = records_to_df([ad for alert_records in snapshot.values() for ad in alert_records]).set_index('id')
+    df_previous = drop_duplicate_ids(df_previous)
+    df_apparts = None
+    cycle = 0
+    logger.info(f'Watching the alerts every {interval} seconds, stop with Ctrl+C.')
+    try:
+        while True:
+            cycle_start = time.monotonic()
+            full_scan = bool(full) if cycle == 0 else (full_every > 0 and cycle % full_every == 0)
+            metrics = RunMetrics(api_utils.API_ROOT, trace_memory=trace_memory)
+            metrics.attach(s)
+            try:
+                if ensure_authenticated(s, headers, email, password):
+                    df_previous, df_apparts = run_cycle(workspace, metrics, s, headers, history_store, links_store, df_previous,
+                                                        df_apparts, full_scan, concurrency, alert_concurrency, link_workers,
+                                                        max_retries, formats, dedup, keep_coords)
+            except Exception as e:
+                # Any failure of a cycle, be it a request or an unexpected response, only skips that cycle.
+                logger.error(f'Watch cycle {cycle} failed, retrying at the next cycle: {e!r}')
+            finally:
+                metrics.detach(s)
+                metrics.write_report(workspace.run_report_path)
+            cycle += 1
+            time.sleep(max(0, interval - (time.monotonic() - cycle_start)))
+    except KeyboardInterrupt:
+        logger.info(f'Stopped watching after {cycle} cycles.')
+    finally:
+        history_store.close()
+        links_store.close()
+
+def stream(workspace, email, password, chunk_size=500, concurrency=8, alert_concurrency=4, link_workers=8, max_retries=5,
+           full=False, history_backend='sqlite', cache_size=100, trace_memory=False, formats=('csv', 'xlsx'), dedup=True,
+           keep_coords=False):
+    # Every chunk of dashboard pages goes through the whole pipeline and is appended to the exports, so that memory
+    # depends on the chunk size rather than on the number of apparts. The dashboards are always fully scanned, the
+    # watermarks and snapshot of the incremental runs are left as they are.
+    metrics = RunMetrics(api_utils.API_ROOT, trace_memory=trace_memory)
+    try:
+        stream_chunks(workspace, metrics, email, password, chunk_size, concurrency, alert_concurrency, link_workers,
+                      max_retries, history_backend, cache_size, formats, dedup, keep_coords)
+    finally:
+        metrics.write_report(workspace.run_report_path)
+
+def stream_chunks(workspace, metrics, email, password, chunk_size, concurrency, alert_concurrency, link_workers, max_retries,
+                  history_backend, cache_size, formats, dedup, keep_coords):
+    with metrics.stage('authenticate'):
+        s, headers = open_session(workspace, email, password, max(concurrency, link_workers), cache_size)
+    metrics.attach(s)
+    with metrics.stage('get_alerts'):
+        df_alerts = get_alerts(s, headers)
+    if history_backend != 'sqlite':
+        # The csv backend reads the whole history on every append.
+        logger.warning('The history is kept in sqlite in streaming mode.')
+    history_store = open_history_store('sqlite', workspace.history_path, workspace.history_db_path)
+    links_store = LinksStore(workspace.links_db_path, workspace.apparts_db_path)
+    exports = StreamingExport(workspace.export_paths, formats)
+    alerts = list(zip(df_alerts['id'], df_alerts['nb_pages']))
+    logger.info(f'Streaming {df_alerts["nb_pages"].sum()} dashboard pages from {len(alerts)} alerts in chunks of {chunk_size} apparts.')
+    pages = iter_dashboard_pages(s, headers, alerts, concurrency, alert_concurrency)
+    # Only the ids seen in the previous chunks are kept, to drop the apparts found by several alerts.
+    seen_ids = set()
+    records = []
+    try:
+        for _, page, ads in pages:
+            records += [{**ad, 'page': page} for ad in ads]
+            if len(records) >= chunk_size:
+                process_chunk(s, metrics, records, seen_ids, history_store, links_store, exports, link_workers, max_retries, dedup,
+                              keep_coords)
+                records = []
+        if len(records) != 0:
+            process_chunk(s, metrics, records, seen_ids, history_store, links_store, exports, link_workers, max_retries, dedup,
+                          keep_coords)
+    finally:
+        pages.close()
+        exports.close()
+        links_store.close()
+    with metrics.stage('history_export'):
+        history_store.export_csv(workspace.history_path)
+        history_store.close()
+    if cache_size > 0:
+        s.get_adapter(api_utils.API_ROOT + '/').log_stats()
+
+def process_chunk(s, metrics, records, seen_ids, history_store, links_store, exports, link_workers=8, max_retries=5, dedup=True,
+                  keep_coords=False):
+    with metrics.stage('ingest'):
+        df_chunk = drop_duplicate_ids(records_to_df(records).set_index('id'))
+        df_chunk = df_chunk.loc[~df_chunk.index.isin(seen_ids)]
+        seen_ids.update(df_chunk.index)
+    if len(df_chunk) == 0:
+        return
+    with metrics.stage('dedup'):
+        groups = duplicate_groups(df_chunk) if dedup else None
+    with metrics.stage('cleaner'):
+        df_chunk = cleaner(df_chunk)
+    with metrics.stage('features_engineering'):
+        df_chunk = features_engineering(df_chunk, keep_coords)
+    with metrics.stage('history_merge'):
+        history_store.append(df_chunk)
+    with metrics.stage('get_all_links'):
+        df_chunk = resolve_links(s, df_chunk, groups, False, links_store, link_workers, max_retries)
+    with metrics.stage('export'):
+        exports.append(df_chunk)
+    logger.info(f'{exports.nb_rows} apparts exported so far.')
+
+def run_account(root, account, email, password, expired, run_options={}, report_options={}):
+    # Entry point of the worker processes: every account has its own session, databases and logs.
+    workspace = Workspace(root, account)
+    workspace.makedirs()
+    logfile(workspace.log_path)
+    logger.info(f'Running the account {account}.')
+    return run_all(workspace, email, password, expired, report_options=report_options, **run_options)
+
+def run_accounts(workspace, accounts, expired, max_workers=None, run_options={}, report_options={}, upload=None):
+    root = os.path.dirname(workspace.databases_path)
+    frames = {}
+    with ProcessPoolExecutor(max_workers=max_workers or len(accounts)) as executor:
+        futures = {account['name']: executor.submit(run_account, root, account['name'], account['email'], account['password'],
+                                                    expired, run_options, report_options)
+                   for account in accounts}
+        for account, future in futures.items():
+            try:
+                frames[account] = future.result()
+            except Exception as e:
+                logger.error(f'The run of the account {account} failed, it is left out of the merged dataset: {e!r}')
+    if len(frames) == 0:
+        logger.critical('Every account failed, nothing to merge.')
+        return None
+
+    df_apparts = merge_accounts(frames)
+    logger.info(f'Merged {sum(len(df) for df in frames.values())} apparts from {len(frames)} accounts into {len(df_apparts)} apparts.')
+    export_apparts(workspace, df_apparts, run_options.get('formats', ('csv', 'xlsx')))
+    history_paths = {account: Workspace(root, account).history_path for account in frames}
+    history_frames = {account: pd.read_csv(path, encoding='utf-8', sep=';', index_col=['id'])
+                      for account, path in history_paths.items() if os.path.exists(path)}
+    if len(history_frames) != 0:
+        merge_accounts(history_frames).to_csv(workspace.history_path, sep=';', encoding='utf-8')
+    if upload is not None:
+        upload(df_apparts)
+    return df_apparts
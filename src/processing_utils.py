@@ -1,32 +1,45 @@
 import os
-import itertools
+from sys import intern
+from itertools import chain
+from operator import itemgetter
 import pandas as pd
 
-def metro_extractor(metro_ls):
-    stops_names = [x['name'] for x in metro_ls]
-    lines_names = [x['lines'] for x in metro_ls]
-    lines_names = set(itertools.chain.from_iterable(lines_names))
-    return [stops_names, lines_names]
+def intern_name(name):
+    return intern(name) if isinstance(name, str) else name
 
 def cleaner(df, columns=['source_logo', 'source_label', 'search_type',
  'rent_max', 'bedroom', 'buy_type', 'new_real_estate', 'webview_link', 'source_description']):
 
-    df['features'] = df['features'].apply(lambda x: {} if pd.isna(x) else x)
-    df_extract = pd.json_normalize(df['features'])
-    df = df.merge(df_extract, how='left', on='id')
+    # The features are normalized in a single call and assigned by position, which avoids a merge on id.
+    # json_normalize is only needed when some features are nested.
+    features = [x if isinstance(x, dict) else {} for x in df['features']]
+    if any(isinstance(value, dict) for appart_features in features for value in appart_features.values()):
+        df_extract = pd.json_normalize(features)
+    else:
+        df_extract = pd.DataFrame.from_records(features)
+    # The features repeat the id of their appart, which is already the index.
+    df_extract = df_extract.drop(columns=['id'], errors='ignore')
+    for column in df_extract.columns:
+        df[column] = df_extract[column].to_numpy()
 
-    metro_res = df['stops'].apply(lambda x: metro_extractor(x))
-    df[['metro_stations', 'metro_lines']] = pd.DataFrame(metro_res.tolist(), index=df.index)
+    stops = [x if isinstance(x, list) else [] for x in df['stops']]
+    get_name, get_lines = itemgetter('name'), itemgetter('lines')
+    # The few station and line names are interned, every appart then refers to the same strings.
+    df['metro_stations'] = [list(map(intern_name, map(get_name, appart_stops))) for appart_stops in stops]
+    df['metro_lines'] = [set(map(intern_name, chain.from_iterable(map(get_lines, appart_stops)))) for appart_stops in stops]
 
     columns_to_drop = columns + ['year', 'box', 'stops', 'features']
-    df = df.drop(columns=columns_to_drop)
+    df = df.drop(columns=columns_to_drop, errors='ignore')
     return df
 
-def features_engineering(df):
+def features_engineering(df, keep_coords=False):
     df['price_m2'] = df['rent'] / df['area']
     df['rent_evolution'] = df['previous_rent'] - df['rent']
-    df['geo_coords'] = df['lat'].astype('string') + ', ' + df['lng'].astype('string')
-    df = df.drop(columns=['previous_rent', 'lat', 'lng'])
+    geo_coords = pd.Series([f'{lat!r}, {lng!r}' for lat, lng in zip(df['lat'].tolist(), df['lng'].tolist())],
+                           index=df.index, dtype='string')
+    df['geo_coords'] = geo_coords.mask(df['lat'].isna() | df['lng'].isna())
+    columns_to_drop = ['previous_rent'] if keep_coords else ['previous_rent', 'lat', 'lng']
+    df = df.drop(columns=columns_to_drop)
     return df 
 
 def append_history_df(df, history_path, sep=';'):
@@ -34,13 +47,33 @@ def append_history_df(df, history_path, sep=';'):
         df_history = pd.read_csv(history_path, encoding='utf-8', sep=sep, index_col=['id'])
     else:
         df_history = pd.DataFrame(columns=df.columns).rename_axis(index='id')
-    new_entries = set(df.index) - set(df_history.index)
+    new_entries = df.index.difference(df_history.index)
     df_to_append = df.loc[new_entries, :]
-    df_history = df_history.append(df_to_append)
+    df_history = pd.concat([df_history, df_to_append])
     return df_history
 
 def update_history_df(df, df_history, expired_index):
-    index_to_update = set(df.index).intersection(set(expired_index))
+    index_to_update = df.index.intersection(expired_index)
     updated_entries = df.loc[index_to_update, :]
     df_history.loc[index_to_update, 'expired_at'] = updated_entries['expired_at']
-    return df_history
\ No newline at end of file
+    return df_history
+
+
+def appart_changes(df_previous, df_current):
+    # Both dataframes are indexed on unique appart ids.
+    new_index = df_current.index.difference(df_previous.index)
+    common_index = df_current.index.intersection(df_previous.index)
+    previous, current = df_previous.loc[common_index], df_current.loc[common_index]
+    # Rents are nullable: a rent that was missing and is now known counts as a change.
+    rent_changed = current['rent'].ne(previous['rent']).fillna(True) & current['rent'].notna()
+    rent_changed_index = common_index[rent_changed.to_numpy(dtype=bool)]
+    expired_index = common_index[current['expired_at'].notna() & previous['expired_at'].isna()]
+    return new_index, rent_changed_index, expired_index
+
+def merge_accounts(frames):
+    # Apparts found by several accounts keep the first non null value of each column, and the list of these accounts.
+    df = pd.concat([df_account.assign(account=account) for account, df_account in frames.items()])
+    accounts = df.groupby(level=0, sort=False)['account'].agg(', '.join)
+    df = df.groupby(level=0, sort=False).first()
+    df['account'] = accounts
+    return df
@@ -0,0 +1,123 @@
+import os
+import json
+import hashlib
+
+from logzero import logger
+
+from export_utils import sanitize_for_excel, to_columnar
+
+class GoogleSheetsUploader:
+    # Full pushes go through gsheets_uploader, batched range updates through the Sheets API with the token it maintains.
+    def __init__(self, credentials_path, token_file_path, secret_client_path):
+        from gsheets_uploader import Uploader
+        self.uploader = Uploader(credentials_path=credentials_path, token_file_path=token_file_path, secret_client_path=secret_client_path)
+        self.token_file_path = token_file_path
+        self.service = None
+
+    def push_table(self, df, spreadsheet_id, worksheet_name, index=True):
+        self.uploader.push_table(df, spreadsheet_id=spreadsheet_id, worksheet_name=worksheet_name, index=index)
+
+    def update_ranges(self, spreadsheet_id, data):
+        if self.service is None:
+            from google.oauth2.credentials import Credentials
+            from googleapiclient.discovery import build
+            self.service = build('sheets', 'v4', credentials=Credentials.from_authorized_user_file(self.token_file_path))
+        body = {'valueInputOption': 'RAW', 'data': data}
+        self.service.spreadsheets().values().batchUpdate(spreadsheetId=spreadsheet_id, body=body).execute()
+
+def column_letter(column_number):
+    letters = ''
+    while column_number > 0:
+        column_number, remainder = divmod(column_number - 1, 26)
+        letters = chr(ord('A') + remainder) + letters
+    return letters
+
+def sheet_rows(df):
+    # Cell values as sent to the sheet: the index comes first, nested values are written as text and missing values are blank.
+    # Sets are sorted first, their iteration order depends on the hash seed of the process and would change the row hashes.
+    table = json.loads(sanitize_for_excel(to_columnar(df)).to_json(orient='split', date_format='iso'))
+    header = [df.index.name or 'id'] + [str(column) for column in df.columns]
+    rows = {str(appart_id): ['' if value is None else value for value in [appart_id] + values]
+            for appart_id, values in zip(table['index'], table['data'])}
+    return header, rows
+
+def row_hash(values):
+    return hashlib.md5(json.dumps(values).encode()).hexdigest()
+
+def load_sheet_snapshot(snapshot_path):
+    if not os.path.exists(snapshot_path):
+        return None
+    with open(snapshot_path, 'r') as f:
+        return json.load(f)
+
+def save_sheet_snapshot(snapshot, snapshot_path):
+    with open(snapshot_path, 'w') as f:
+        json.dump(snapshot, f)
+
+def plan_row_updates(snapshot, rows):
+    # Rows keep their position in the sheet: updated rows are written in place, new rows first fill the
+    # rows left blank by deleted apparts, then are appended, and the remaining deleted rows are blanked.
+    hashes = {appart_id: row_hash(values) for appart_id, values in rows.items()}
+    positions = dict(snapshot['positions'])
+    deleted_ids = [appart_id for appart_id in positions if appart_id not in rows]
+    free_rows = sorted(snapshot['free_rows'] + [positions.pop(appart_id) for appart_id in deleted_ids])
+    next_row = max(list(positions.values()) + free_rows, default=1) + 1
+    updates = {}
+    nb_inserted, nb_updated = 0, 0
+    for appart_id, values in rows.items():
+        if appart_id in positions:
+            if snapshot['hashes'][appart_id] == hashes[appart_id]:
+                continue
+            nb_updated += 1
+        else:
+            nb_inserted += 1
+            if len(free_rows) != 0:
+                positions[appart_id] = free_rows.pop(0)
+            else:
+                positions[appart_id] = next_row
+                next_row += 1
+        updates[positions[appart_id]] = values
+    width = len(snapshot['header'])
+    blank_rows = [row for row in free_rows if row not in snapshot['free_rows']]
+    for row in blank_rows:
+        updates[row] = [''] * width
+    new_snapshot = {**snapshot, 'hashes': hashes, 'positions': positions, 'free_rows': free_rows}
+    logger.info(f'Sheet upload: {nb_inserted} inserts, {nb_updated} updates and {len(deleted_ids)} deletes.')
+    return updates, new_snapshot
+
+def range_updates(updates, worksheet_name, width):
+    # Consecutive rows are sent as a single range.
+    data = []
+    for row in sorted(updates):
+        if len(data) != 0 and data[-1]['last_row'] == row - 1:
+            data[-1]['last_row'] = row
+            data[-1]['values'].append(updates[row])
+        else:
+            data.append({'first_row': row, 'last_row': row, 'values': [updates[row]]})
+    last_column = column_letter(width)
+    return [{'range': f"'{worksheet_name}'!A{block['first_row']}:{last_column}{block['last_row']}", 'values': block['values']}
+            for block in data]
+
+def sync_table(uploader, df, spreadsheet_id, worksheet_name, snapshot_path, batch_size=500, max_free_share=0.25,
+               force_full=False):
+    header, rows = sheet_rows(df)
+    snapshot = load_sheet_snapshot(snapshot_path)
+    full_push = force_full or (snapshot is None) or (snapshot['header'] != header) or \
+        (snapshot['spreadsheet_id'], snapshot['worksheet_name']) != (spreadsheet_id, worksheet_name)
+    if not full_push:
+        updates, new_snapshot = plan_row_updates(snapshot, rows)
+        # Too many blank rows left by deleted apparts: the sheet is rewritten to compact it.
+        full_push = len(new_snapshot['free_rows']) > max_free_share * max(len(rows), 1)
+    if full_push:
+        logger.info(f'Pushing the whole {worksheet_name} worksheet ({len(rows)} rows).')
+        uploader.push_table(to_columnar(df), spreadsheet_id=spreadsheet_id, worksheet_name=worksheet_name, index=True)
+        new_snapshot = {'spreadsheet_id': spreadsheet_id, 'worksheet_name': worksheet_name, 'header': header,
+                        'hashes': {appart_id: row_hash(values) for appart_id, values in rows.items()},
+                        'positions': {appart_id: position + 2 for position, appart_id in enumerate(rows)}, 'free_rows': []}
+    else:
+        data = range_updates(updates, worksheet_name, len(header))
+        for start in range(0, len(data), batch_size):
+            uploader.update_ranges(spreadsheet_id, data[start:start + batch_size])
+        logger.info(f'Sent {len(updates)} rows in {len(data)} ranges to the {worksheet_name} worksheet.')
+    save_sheet_snapshot(new_snapshot, snapshot_path)
+    return full_push
@@ -0,0 +1,215 @@
+import os
+import json
+import sqlite3
+import threading
+from datetime import datetime
+import pandas as pd
+from logzero import logger
+
+from processing_utils import append_history_df, update_history_df
+
+def to_sql_value(value):
+    if isinstance(value, (list, tuple, set, dict)):
+        return str(value)
+    if pd.isna(value):
+        return None
+    if hasattr(value, 'item'):
+        value = value.item()
+    if isinstance(value, bool) or not isinstance(value, (str, int, float)):
+        return str(value)
+    return value
+
+class CsvHistoryStore:
+    # Legacy backend: the whole history is loaded in memory and rewritten on export.
+    def __init__(self, history_path, sep=';'):
+        self.history_path = history_path
+        self.sep = sep
+        self.df_history = None
+
+    def append(self, df):
+        self.df_history = append_history_df(df, self.history_path, self.sep)
+
+    def update_expired(self, df, expired_index):
+        self.df_history = update_history_df(df, self.df_history, expired_index)
+
+    def export_csv(self, csv_path=None):
+        self.df_history.to_csv(csv_path or self.history_path, sep=self.sep, encoding='utf-8')
+
+    def close(self):
+        self.df_history = None
+
+class SqliteHistoryStore:
+    # Keyed on the appart id: new apparts are inserted and expiration dates are updated in place,
+    # without reading the rest of the history. The CSV export only appends the apparts inserted since
+    # the previous export, it is rewritten when existing rows or the columns changed.
+    def __init__(self, db_path, history_path=None, sep=';', chunksize=10000):
+        self.sep = sep
+        self.chunksize = chunksize
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS history (id TEXT PRIMARY KEY)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS csv_export (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER, '
+                          'mtime_ns INTEGER, last_rowid INTEGER, rewrite INTEGER)')
+        # A CSV history which is not the last export of this database, for instance after runs with the csv
+        # backend, is the most recent one: the database is rebuilt from it.
+        if (history_path is not None) and os.path.exists(history_path) and not self.csv_in_sync(history_path):
+            logger.info(f'Importing the CSV history {history_path} into {db_path}.')
+            with self.conn:
+                self.conn.execute('DROP TABLE history')
+                self.conn.execute('CREATE TABLE history (id TEXT PRIMARY KEY)')
+            for df_chunk in pd.read_csv(history_path, encoding='utf-8', sep=sep, index_col=['id'], chunksize=chunksize):
+                self.append(df_chunk)
+            self.save_export_state(history_path)
+
+    def export_state(self):
+        return self.conn.execute('SELECT size, mtime_ns, last_rowid, rewrite FROM csv_export').fetchone()
+
+    def csv_in_sync(self, csv_path):
+        state = self.export_state()
+        if (state is None) or not os.path.exists(csv_path):
+            return False
+        stat = os.stat(csv_path)
+        return (stat.st_size, stat.st_mtime_ns) == state[:2]
+
+    def save_export_state(self, csv_path):
+        stat = os.stat(csv_path)
+        last_rowid = self.conn.execute('SELECT MAX(rowid) FROM history').fetchone()[0] or 0
+        with self.conn:
+            self.conn.execute('INSERT OR REPLACE INTO csv_export (id, size, mtime_ns, last_rowid, rewrite) VALUES (0, ?, ?, ?, 0)',
+                              (stat.st_size, stat.st_mtime_ns, last_rowid))
+
+    def require_rewrite(self):
+        # Kept in the database, so that the CSV is still rewritten when the run stops before its export.
+        self.conn.execute('UPDATE csv_export SET rewrite = 1')
+
+    def columns(self):
+        return [row[1] for row in self.conn.execute('PRAGMA table_info(history)')]
+
+    def add_columns(self, columns):
+        existing_columns = set(self.columns())
+        new_columns = [column for column in columns if column not in existing_columns]
+        for column in new_columns:
+            self.conn.execute(f'ALTER TABLE history ADD COLUMN "{column}"')
+        if new_columns:
+            self.require_rewrite()
+
+    def append(self, df):
+        columns = [str(column) for column in df.columns]
+        column_names = ', '.join(f'"{column}"' for column in ['id'] + columns)
+        placeholders = ', '.join('?' * (len(columns) + 1))
+        rows = ([str(appart_id)] + [to_sql_value(value) for value in values]
+                for appart_id, values in zip(df.index, df.itertuples(index=False, name=None)))
+        with self.conn:
+            self.add_columns(columns)
+            nb_changes = self.conn.total_changes
+            self.conn.executemany(f'INSERT OR IGNORE INTO history ({column_names}) VALUES ({placeholders})', rows)
+            nb_new_entries = self.conn.total_changes - nb_changes
+        logger.info(f'{nb_new_entries} new apparts have been added to the history.')
+
+    def update_expired(self, df, expired_index):
+        index_to_update = df.index.intersection(expired_index)
+        updated_entries = df.loc[index_to_update, 'expired_at']
+        updated_entries = updated_entries[~updated_entries.index.duplicated()]
+        with self.conn:
+            self.conn.executemany('UPDATE history SET expired_at = ? WHERE id = ?',
+                                  ((to_sql_value(expired_at), str(appart_id)) for appart_id, expired_at in updated_entries.items()))
+            if len(updated_entries) != 0:
+                self.require_rewrite()
+
+    def export_csv(self, csv_path):
+        state = self.export_state()
+        if self.csv_in_sync(csv_path) and not state[3]:
+            query, params, header = 'SELECT * FROM history WHERE rowid > ? ORDER BY rowid', (state[2],), False
+        else:
+            query, params, header = 'SELECT * FROM history ORDER BY rowid', (), True
+        nb_rows = 0
+        for df_chunk in pd.read_sql_query(query, self.conn, params=params, index_col='id', chunksize=self.chunksize):
+            df_chunk.to_csv(csv_path, sep=self.sep, encoding='utf-8', mode='w' if header else 'a', header=header)
+            header = False
+            nb_rows += len(df_chunk)
+        if header:
+            pd.DataFrame(columns=self.columns()).set_index('id').to_csv(csv_path, sep=self.sep, encoding='utf-8')
+        if params and (nb_rows == 0):
+            logger.info('The history has not changed, skipping its CSV export.')
+        elif params:
+            logger.info(f'Appended {nb_rows} new apparts to the CSV history.')
+        self.save_export_state(csv_path)
+
+    def close(self):
+        self.conn.close()
+
+class LinksStore:
+    # Resolved links keyed on the appart id. Links are written in batches while they are resolved,
+    # so an interrupted run resumes where it stopped. checked_at is only set when the expiration of
+    # the appart was checked along with its link.
+    def __init__(self, db_path, json_path=None):
+        migrate = (not os.path.exists(db_path)) and (json_path is not None) and os.path.exists(json_path)
+        self.conn = sqlite3.connect(db_path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS links (id TEXT PRIMARY KEY, link TEXT, true_expired_at TEXT, resolved_at TEXT)')
+        columns = [row[1] for row in self.conn.execute('PRAGMA table_info(links)')]
+        for column in ['true_expired_at', 'checked_at']:
+            if column not in columns:
+                self.conn.execute(f'ALTER TABLE links ADD COLUMN {column} TEXT')
+        if migrate:
+            logger.info(f'Importing the links database {json_path} into {db_path}.')
+            df_links = pd.read_json(json_path, orient='columns')
+            self.put_many(((appart_id, link, None) for appart_id, link in df_links['link'].items()),
+                          resolved_at=datetime.fromtimestamp(os.path.getmtime(json_path)))
+
+    def get_many(self, ids, checked_after=None, batch_size=500):
+        # Without checked_after every stored link is returned, otherwise only the links whose expiration was checked since then.
+        ids = [str(appart_id) for appart_id in ids]
+        condition = '' if checked_after is None else ' AND checked_at >= ?'
+        links = {}
+        for start in range(0, len(ids), batch_size):
+            batch = ids[start:start + batch_size]
+            placeholders = ', '.join('?' * len(batch))
+            parameters = batch if checked_after is None else batch + [checked_after.isoformat()]
+            rows = self.conn.execute(f'SELECT id, link, true_expired_at FROM links WHERE id IN ({placeholders}){condition}',
+                                     parameters)
+            links.update((appart_id, (link, true_expired_at)) for appart_id, link, true_expired_at in rows)
+        return links
+
+    def put_many(self, links, resolved_at=None, checked=False):
+        resolved_at = (resolved_at or datetime.now()).isoformat()
+        checked_at = resolved_at if checked else None
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO links (id, link, true_expired_at, resolved_at, checked_at) VALUES (?, ?, ?, ?, ?)',
+                                  ((str(appart_id), link, true_expired_at, resolved_at, checked_at)
+                                   for appart_id, link, true_expired_at in links))
+
+    def close(self):
+        self.conn.close()
+
+class AbuseJournal:
+    # Append-only journal of the abuse reports sent to Jinka, one JSON line per report. Each report is
+    # written as soon as it is acknowledged, so an interrupted run never sends it twice.
+    def __init__(self, journal_path):
+        self.journal_path = journal_path
+        self.lock = threading.Lock()
+
+    def reported_ids(self):
+        if not os.path.exists(self.journal_path):
+            return set()
+        reported_ids = set()
+        with open(self.journal_path, 'r', encoding='utf-8') as f:
+            for line in f:
+                try:
+                    reported_ids.add(str(json.loads(line)['id']))
+                except (ValueError, KeyError):
+                    # A line cut short by a crash is ignored, its report will be sent again.
+                    continue
+        return reported_ids
+
+    def append(self, appart_id, alert_id, status_code):
+        entry = {'id':str(appart_id), 'alert_id':alert_id, 'status_code':status_code, 'reported_at':datetime.now().isoformat()}
+        with self.lock, open(self.journal_path, 'a', encoding='utf-8') as f:
+            f.write(json.dumps(entry) + '\n')
+            f.flush()
+            os.fsync(f.fileno())
+
+def open_history_store(backend, history_path, db_path=None, sep=';'):
+    if backend == 'csv':
+        return CsvHistoryStore(history_path, sep)
+    if backend == 'sqlite':
+        return SqliteHistoryStore(db_path, history_path, sep)
+    raise ValueError(f'Unknown history backend {backend}')